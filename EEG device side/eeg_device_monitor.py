@@ -1,13 +1,15 @@
 import cv2
 import time
-import json
+import orjson
 import pickle
 import pyaudio
 import numpy as np
 
-from threading import Thread
+from queue import Queue
+from threading import Thread, Lock
 from matplotlib import pyplot as plt
 from matplotlib.animation import FuncAnimation
+from matplotlib.collections import LineCollection
 
 from sync.routine_center.client_base import BaseClientSocket
 from eeg_device_reader_ssvep_simulation import EEGDeviceReader, convert_data_into_array
@@ -29,16 +31,30 @@ class Decoder(object):
     # It should aligned with pretrained svm.
     freqs = np.arange(8, 16, 0.3)
 
+    def __init__(self):
+        # The persistent (1, 4001) features buffer.
+        # The libsvm backend works on C-contiguous float64 array,
+        # so the buffer is passed to the svm without another conversion.
+        self._feat = np.zeros((1, 4001), dtype=np.float64)
+        self._feat_lock = Lock()
+        # Warm up the svm, so its first-call initialization is not in the trial.
+        self.svm.predict(self._feat)
+
     def predict(self, data):
         # Data shape is (n_time_points, n_channels).
-        # Convert into (1, 4001) features.
-        features = data[:4001, 0][np.newaxis, :]
-        predicted_labels = self.svm.predict(features)
+        # Copy the channel 0 into the (1, 4001) features buffer.
+        with self._feat_lock:
+            np.copyto(self._feat[0], data[:4001, 0])
+            predicted_labels = self.svm.predict(self._feat)
         return [self.freqs[e] for e in predicted_labels]
 
 
 decoder = Decoder()
 
+# The random omegas for the pretending decoding.
+_RNG = np.random.default_rng()
+_AVAILABLE_OMEGA = np.linspace(5, 30, 26)
+
 
 class SocketClient(BaseClientSocket):
     path = '/eeg/monitor'
@@ -47,14 +63,22 @@ class SocketClient(BaseClientSocket):
 
     def __init__(self, host=None, port=None, timeout=None):
         super().__init__(**dict(host=host, port=port, timeout=timeout))
+        # The SSVEP trials are decoded one by one in the persistent worker thread.
+        self._trial_q = Queue()
+        Thread(target=self._trial_worker, daemon=True).start()
+
+    def _trial_worker(self):
+        while True:
+            onstart_time, cueOmega, letter = self._trial_q.get()
+            self.wait_for_data(onstart_time, cueOmega, letter)
 
     def handle_message(self, message):
         super().handle_message(message)
         # Recover the letter.
-        letter = json.loads(message)
+        letter = orjson.loads(message)
 
         # Deal with content
-        content = json.loads(letter['content'])
+        content = orjson.loads(letter['content'])
         action = content.get('action')
         cue = content.get('cue')
         cueOmega = content.get('cueOmega')
@@ -70,8 +94,7 @@ class SocketClient(BaseClientSocket):
                 eeg_device_reader.fill_ssvep_chunk_data(cueOmega)
 
             # Wait a while for decoding
-            Thread(target=self.wait_for_data,
-                   args=(onstart_time, cueOmega, letter), daemon=True).start()
+            self._trial_q.put((onstart_time, cueOmega, letter))
 
         # Mark the letter as failure.
         else:
@@ -88,25 +111,21 @@ class SocketClient(BaseClientSocket):
             time_resolution = eeg_device_reader.time_resolution
 
             # Get data after required length seconds.
-            time.sleep(data_length_required)
-            while True:
-                data = eeg_device_reader.peek_latest_data_by_seconds(
-                    data_length_required)
-
-                # Break if already got enough data.
-                # If failed, sleep until the next package arrival.
-                t = data[-1][1]
-                if t > onstart_time + data_length_required + package_interval:
-                    break
-                else:
-                    time.sleep(package_interval)
+            # The reader wakes up the waiting when the package arrives.
+            eeg_device_reader.wait_for_package_after(
+                onstart_time + data_length_required + package_interval)
+            data = eeg_device_reader.peek_latest_data_by_seconds(
+                data_length_required)
 
             # Deal with the data
             data, times = convert_data_into_array(
                 data, package_interval, time_resolution)
 
-            data = data[times >= onstart_time]
-            times = times[times >= onstart_time]
+            # The times are descending, so the slices since the onstart_time are the head.
+            # Find the cut with the binary search, and slice the views.
+            k = len(times) - np.searchsorted(times[::-1], onstart_time)
+            data = data[:k]
+            times = times[:k]
 
             pred_freq = decoder.predict(data)
             pred_freq = float(pred_freq[0])
@@ -116,30 +135,29 @@ class SocketClient(BaseClientSocket):
             # Send back the decoding result.
             letter['dst'] = letter['src']
             letter['src'] = self.path_uid
-            content = json.loads(letter['content'])
+            content = orjson.loads(letter['content'])
 
             # ! I am pretending process the decoding.
             # Here, I am just adding a random omega for demonstration if the cueOmega is not given.
             # In real-world scenario, you should replace this with your decoding process.
-            content.update({'decodedOmega': np.random.uniform(5, 30)})
             if omega := content.get('cueOmega'):
                 content.update({'decodedOmega': omega})
             else:
-                available_omega = np.linspace(5, 30, 26)
-                np.random.shuffle(available_omega)
-                content.update({'decodedOmega': available_omega[0]})
-            letter['content'] = json.dumps(content)
+                content.update(
+                    {'decodedOmega': float(_RNG.choice(_AVAILABLE_OMEGA))})
+            letter['content'] = orjson.dumps(content).decode()
 
-            self.send_message(json.dumps(letter))
+            # Send the serialized bytes directly.
+            self.send_message(orjson.dumps(letter))
 
             # Mark the letter as finished.
             if lt := self.mm.bag_pending.fetch_letter(letter['uid']):
-                self.mm.bag_finished.insert_letter(lt)
-                self.mm.bag_finished.insert_letter(letter)
+                self.mm.bag_finished.insert_letter(lt, copy=False)
+                self.mm.bag_finished.insert_letter(letter, copy=False)
         except Exception as err:
             if lt := self.mm.bag_pending.fetch_letter(letter['uid']):
                 lt.update({'_fail_reason': f'{type(err)}({err})'})
-                self.mm.bag_failed.insert_letter(lt)
+                self.mm.bag_failed.insert_letter(lt, copy=False)
         return
 
 
@@ -150,11 +168,17 @@ client.connect()
 class AudioStream:
     SAMPLESIZE = 4096  # number of data points to read at a time
     SAMPLERATE = 44100  # time resolution of the recording device (Hz)
+    RINGSIZE = 4  # number of the latest audio blocks being kept
 
     def __init__(self):
         self.p = pyaudio.PyAudio()
         self.stream = None
         self.audio_available = False
+        # The ring buffer of the audio blocks.
+        # The producer thread is the only writer, so the latest block is read without lock.
+        self.ring = np.zeros((self.RINGSIZE, self.SAMPLESIZE), dtype=np.int16)
+        self.write_idx = 0
+        self.producer = None
         self.init_audio()
 
     def init_audio(self):
@@ -169,21 +193,36 @@ class AudioStream:
             self.audio_available = True
             print(self.stream)
             print(np.frombuffer(self.stream.read(self.SAMPLESIZE), dtype=np.int16))
+
+            # Read the audio in the background, so the animation never waits for the device.
+            self.producer = Thread(target=self._producer, daemon=True)
+            self.producer.start()
         except Exception as e:
             print(f"Audio device error: {e}")
             self.audio_available = False
 
-    def read_audio(self):
-        if self.audio_available:
+    def _producer(self):
+        while self.audio_available:
             try:
-                return np.frombuffer(self.stream.read(self.SAMPLESIZE), dtype=np.int16)
+                buf = self.stream.read(
+                    self.SAMPLESIZE, exception_on_overflow=False)
             except Exception as e:
                 print(f"Audio read error: {e}")
                 return
+            self.ring[self.write_idx % self.RINGSIZE] = np.frombuffer(
+                buf, dtype=np.int16)
+            self.write_idx += 1
+
+    def read_audio(self):
+        # Copy the latest audio block, None if it is not available yet.
+        if self.audio_available and self.write_idx > 0:
+            return self.ring[(self.write_idx - 1) % self.RINGSIZE].copy()
         return
 
     def close(self):
         if self.audio_available:
+            self.audio_available = False
+            self.producer.join(timeout=1)
             self.stream.stop_stream()
             self.stream.close()
             self.p.terminate()
@@ -218,15 +257,20 @@ class CameraStream:
 
 
 class FPSCounter:
-    def __init__(self):
-        self.start_time = time.time()
-        self.frame_count = 0
+    '''The instantaneous FPS, smoothed by the exponential moving average.'''
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self._last = time.time()
+        self._ema = 0.0
 
     def update(self):
-        self.frame_count += 1
-        elapsed_time = time.time() - self.start_time
-        fps = self.frame_count / elapsed_time
-        return fps
+        now = time.time()
+        dt = now - self._last
+        self._last = now
+        self._ema = (1 - self.alpha) * self._ema + \
+            self.alpha * (1 / dt if dt else 0)
+        return self._ema
 
 
 if __name__ == "__main__":
@@ -255,36 +299,63 @@ if __name__ == "__main__":
     ax_large = fig.add_subplot(2, 2, (1, 3))
     ax_large.set_title('Larger Graph')
     ax_large.set_ylim(-1, channels+1)
+    # The eeg data is always drawn in the (0, 1) range.
+    ax_large.set_xlim(0, 1)
 
-    channel_lines = [ax_large.plot([], [], lw=1) for _ in range(channels)]
+    # All the channels are drawn by one artist, colored by the color cycle.
+    channel_lines = LineCollection(
+        [], linewidths=1, colors=plt.rcParams['axes.prop_cycle'].by_key()['color'])
+    ax_large.add_collection(channel_lines)
     # line2, = ax_large.plot([], [], lw=1)
 
+    # The persistent camera image, its data is replaced in every frame.
+    # The nearest interpolation skips the antialiasing resample of the frame in every draw.
+    im = ax4.imshow(np.zeros((240, 320, 3), np.uint8),
+                    interpolation='nearest', resample=False)
+    ax4.axis('off')  # Hide axes for the camera feed
+    ax4.set_aspect('auto')  # Set aspect ratio to auto
+
+    # The FPS is drawn inside the axes, since the blitting only redraws the axes.
+    fps_text = ax_large.text(0.01, 0.99, '', transform=ax_large.transAxes, va='top')
+
     # x axis data points
-    x = np.linspace(0, audio_stream.SAMPLESIZE-1, audio_stream.SAMPLESIZE)
+    x = np.arange(audio_stream.SAMPLESIZE, dtype=np.float32)
+    # The display offsets of the eeg channels.
+    channel_offsets = np.arange(channels, dtype=np.float32)[:, np.newaxis]
+    # The eeg segments buffer of (n_channels, n_time_points, 2) by the number of time points.
+    # The x axis is filled once, and the y axis is overwritten in every frame.
+    segs_cache = {}
 
     # Initialize FPS counter
     fps_counter = FPSCounter()
 
+    # The artists redrawn by the blitting.
+    artists = (line, im, fps_text, channel_lines)
+
     def init():
         line.set_data([], [])
-        return line,
+        return artists
 
     def animate(i_frame):
-        e = eeg_device_reader.peek_latest_data_by_length(50)
-        first = e[0]
-        last = e[-1]
+        # The shape of arr is (n_packages, n_channels, package_length).
+        arr, ts, idx = eeg_device_reader.peek_latest_array(50)
 
         if i_frame % 200 == 0:
             client.send_message(f'Info. Display {i_frame} frame.')
             print(
-                first[0], last[0], first[1], last[1],
-                last[1]-first[1], first[2].shape, len(e))
-
-        y2 = np.concatenate([d[2] for d in e], axis=1)
-        x2 = np.linspace(0, 1, y2.shape[1])
-        for i in range(channels):
-            channel_lines[i][0].set_data(x2, y2[i]+i)
-        ax_large.set_xlim((x2[0], x2[-1]))
+                idx[0], idx[-1], ts[0], ts[-1],
+                ts[-1]-ts[0], arr[0].shape, len(arr))
+
+        # Lay the packages side by side, the shape is (n_channels, n_time_points).
+        y2 = arr.transpose(1, 0, 2).reshape(channels, -1)
+        # The x axis only changes with the number of the time points.
+        n_points = y2.shape[1]
+        if (segs := segs_cache.get(n_points)) is None:
+            segs = segs_cache[n_points] = np.empty((channels, n_points, 2))
+            segs[:, :, 0] = np.linspace(0, 1, n_points)
+        # Offset all the channels in one add, and update them at once.
+        np.add(y2, channel_offsets, out=segs[:, :, 1])
+        channel_lines.set_segments(segs)
 
         # Update audio plot
         y = audio_stream.read_audio()
@@ -294,19 +365,19 @@ if __name__ == "__main__":
         # Update camera feed
         frame = camera_stream.read_frame()
         if frame is not None:
-            ax4.clear()
-            ax4.imshow(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            ax4.axis('off')  # Hide axes for the camera feed
-            ax4.set_aspect('auto')  # Set aspect ratio to auto
+            # Reverse the BGR channels into RGB on the view, without converting the frame.
+            im.set_data(frame[..., ::-1])
 
-        # Calculate and update FPS in title
+        # Calculate FPS, and update its text every 10 frames
         fps = fps_counter.update()
-        fig.suptitle(f'FPS: {fps:.2f}')
+        if i_frame % 10 == 0:
+            fps_text.set_text(f'FPS: {fps:.2f}')
 
-        return line,
+        return artists
 
+    # The monitor runs indefinitely, so the frames are not cached.
     ani = FuncAnimation(fig, animate, init_func=init,
-                        frames=200, interval=20, blit=False)
+                        interval=20, blit=True, cache_frame_data=False)
 
     # def check_plot_closed():
     #     if not plt.fignum_exists(fig.number):
@@ -23,7 +23,7 @@ import time
 import numpy as np
 import matplotlib.pyplot as plt
 
-from threading import Thread
+from threading import Thread, Event
 from datetime import datetime
 
 from omegaconf import OmegaConf
@@ -82,9 +82,20 @@ class EEGDeviceReader(object):
     def __init__(self):
         self.conf_override()
         self.running = False
-
-        LOGGER.debug(
-            'Initialize {} with {}'.format(self.__class__, self.__dict__))
+        # It is set to stop the reading loop.
+        self._stop_event = Event()
+
+        # The data buffer is the ring of the packages in the SoA layout, the data is stored in float32.
+        # The package of the ring's slot is (idx, timestamp, data of (channels x package_length)).
+        # The slot is written at self._head % self.packages_limit, the oldest package is overwritten.
+        self._data_ring = np.empty(
+            (self.packages_limit, self.channels, self.package_length), dtype=np.float32)
+        self._ts_ring = np.empty(self.packages_limit, dtype=np.float64)
+        self._idx_ring = np.empty(self.packages_limit, dtype=np.int64)
+        self._head = 0
+
+        LOGGER.opt(lazy=True).debug(
+            'Initialize {} with {}', lambda: self.__class__, lambda: self.__dict__)
         pass
 
     def conf_override(self):
@@ -96,6 +107,11 @@ class EEGDeviceReader(object):
 
         self.package_interval = self.package_length / \
             self.sample_rate  # Interval between packages
+        # The display offsets of the channels, it is added to the (channels x times) data.
+        self._offset_col = np.arange(
+            self.channels, dtype=np.float32).reshape(-1, 1)
+        # The time offsets of the time points in the package.
+        self._j_over_sr = np.arange(self.package_length) / self.sample_rate
 
         LOGGER.debug('Override the options with CONF')
 
@@ -112,33 +128,38 @@ class EEGDeviceReader(object):
 
     def stop(self):
         self.running = False
+        self._stop_event.set()
 
     def _read_data(self):
         """Simulate the EEG device reading,
         it is called by the self.run_forever() method.
         """
 
-        self.data_buffer = []
+        self._head = 0
         self._read_data_idx = 0
 
+        # The monotonic deadline of the next package, the wall clock only stamps the packages.
+        next_tick = time.monotonic()
+
         LOGGER.debug('Read data loop starts.')
         while self.running:
             t = time.time()
-            incoming = np.zeros((self.channels, self.package_length)) + t
-
-            for j in range(self.package_length):
-                incoming[:, j] += j / self.sample_rate
-                incoming[:, j] %= 1
-
-            self.data_buffer.append((self._read_data_idx, t, incoming))
+            # All the channels share the same row, it is broadcast into the slot of the ring.
+            # The head moves after the slot is written, so the readers only see the complete packages.
+            slot = self._head % self.packages_limit
+            self._data_ring[slot] = (t + self._j_over_sr) % 1
+            self._ts_ring[slot] = t
+            self._idx_ring[slot] = self._read_data_idx
+            self._head += 1
             self._read_data_idx += 1
 
-            if self.get_data_buffer_size() > self.packages_limit:
-                LOGGER.warning(
-                    'Data buffer exceeds {} packages.'.format(self.packages_limit))
-                self.data_buffer.pop(0)
-
-            time.sleep(self.package_interval)
+            # Make sure the next loop starts after $self.package_interval seconds.
+            # If the loop falls behind, it starts at once without catching up.
+            # The waiting is interrupted at once when the reader stops.
+            now = time.monotonic()
+            next_tick = max(next_tick + self.package_interval, now)
+            if self._stop_event.wait(next_tick - now):
+                break
 
         LOGGER.debug('Read data loop stops.')
 
@@ -152,17 +173,53 @@ class EEGDeviceReader(object):
         Returns:
             2d array: The data with offset
         """
-        for j, d in enumerate(data):
-            d += j
+        data += self._offset_col
         return data
 
     def get_data_buffer_size(self):
-        """Get the current buffer size for the data_buffer
+        """Get the current buffer size for the data ring
 
         Returns:
             int: The buffer size.
         """
-        return len(self.data_buffer)
+        return min(self._head, self.packages_limit)
+
+    def peek_latest_array(self, length=50):
+        """Peek the latest data in the data ring with given length in packages.
+
+        The data is the view of the ring if it does not wrap around, otherwise it is copied.
+        The view is valid until the ring is overwritten, which takes self.packages_limit packages.
+
+        If there is no data available, return None.
+
+        Args:
+            length (int, optional): How many packages are required. Defaults to 50.
+
+        Returns:
+            tuple: The (data, timestamps, indices) of the packages.
+                The shape of data is (length, self.channels, self.package_length).
+            None if there is no data available.
+        """
+        head = self._head
+        size = min(head, self.packages_limit)
+        if size < 1:
+            return None
+
+        length = min(length, size)
+        start = (head - length) % self.packages_limit
+        stop = start + length
+
+        # The packages are contiguous in the ring.
+        if stop <= self.packages_limit:
+            return (self._data_ring[start:stop],
+                    self._ts_ring[start:stop],
+                    self._idx_ring[start:stop])
+
+        # The packages wrap around the end of the ring.
+        stop -= self.packages_limit
+        return (np.concatenate((self._data_ring[start:], self._data_ring[:stop])),
+                np.concatenate((self._ts_ring[start:], self._ts_ring[:stop])),
+                np.concatenate((self._idx_ring[start:], self._idx_ring[:stop])))
 
     def peek_latest_data_by_length(self, length=50):
         """Peek the latest data in the self.data_buffer with given length.
@@ -176,10 +233,12 @@ class EEGDeviceReader(object):
             list: The data being fetched. The elements of the list are (idx, timestamp, data of (self.channels x self.package_length)).
             None if there is no data available.
         """
-        if self.get_data_buffer_size() < 1:
+        latest = self.peek_latest_array(length)
+        if latest is None:
             return None
 
-        output = [e for e in self.data_buffer[-length:]]
+        data, ts, idx = latest
+        output = list(zip(idx.tolist(), ts.tolist(), data))
 
         return output
 
@@ -187,6 +246,7 @@ class EEGDeviceReader(object):
         """Run the loops forever.
         """
         self.running = True
+        self._stop_event.clear()
         Thread(target=self._read_data, daemon=True).start()
         pass
 
@@ -20,13 +20,13 @@ Functions:
 # %% ---- 2023-07-24 ------------------------
 # Requirements and constants
 import time
+import functools
 import contextlib
 import numpy as np
 
 from omegaconf import OmegaConf
-from threading import Thread, RLock
+from threading import Thread, RLock, Condition, Event
 from loguru import logger as LOGGER
-from scipy.stats import multivariate_normal
 
 # %% ---- 2023-07-24 ------------------------
 # Function and class
@@ -39,14 +39,26 @@ eeg_config = dict(
 
 CONF = OmegaConf.create(dict(eeg=eeg_config))
 
+# The random generator of the simulation noise.
+_RNG = np.random.default_rng()
 
+
+def gauss2d(x, y, mux, muy, sx, sy):
+    '''
+    The pdf of the 2d gaussian with the diagonal covariance.
+    It equals multivariate_normal.pdf([x, y], [mux, muy], [[sx, 0], [0, sy]]).
+    '''
+    return np.exp(-0.5 * ((x-mux)**2 / sx + (y-muy)**2 / sy)) / (2 * np.pi * np.sqrt(sx * sy))
+
+
+@functools.lru_cache(maxsize=8)
 def generate_trf(fs_eeg):
     tmin, tmax = -0.1, 0.4
     delays_samp = np.arange(np.round(tmin * fs_eeg),
                             np.round(tmax * fs_eeg) + 1).astype(int)
     delays_sec = delays_samp / fs_eeg
-    grid = np.array(np.meshgrid(delays_sec, 1))
-    grid = grid.swapaxes(0, -1).swapaxes(0, 1)
+    # The grid is (delays_sec, 1).
+    x, y = delays_sec, 1
 
     means_high = [0.1, 1]
     means_low = [0.13, 1]
@@ -54,15 +66,16 @@ def generate_trf(fs_eeg):
     means_low2 = [0.23, 1]
     means_high3 = [0.3, 1]
     means_low3 = [0.33, 1]
-    cov = [[0.0002, 0], [0, 500]]  # 5000
-    cov2 = [[0.0004, 0], [0, 50000]]  # 5000
-    cov3 = [[0.0006, 0], [0, 100000]]  # 5000
-    gauss_high = multivariate_normal.pdf(grid, means_high, cov)
-    gauss_low = -1 * multivariate_normal.pdf(grid, means_low, cov)
-    gauss_high2 = multivariate_normal.pdf(grid, means_high2, cov2)
-    gauss_low2 = -1 * multivariate_normal.pdf(grid, means_low2, cov2)
-    gauss_high3 = multivariate_normal.pdf(grid, means_high3, cov3)
-    gauss_low3 = -1 * multivariate_normal.pdf(grid, means_low3, cov3)
+    # The diagonals of the covariances.
+    cov = [0.0002, 500]  # 5000
+    cov2 = [0.0004, 50000]  # 5000
+    cov3 = [0.0006, 100000]  # 5000
+    gauss_high = gauss2d(x, y, *means_high, *cov)
+    gauss_low = -1 * gauss2d(x, y, *means_low, *cov)
+    gauss_high2 = gauss2d(x, y, *means_high2, *cov2)
+    gauss_low2 = -1 * gauss2d(x, y, *means_low2, *cov2)
+    gauss_high3 = gauss2d(x, y, *means_high3, *cov3)
+    gauss_low3 = -1 * gauss2d(x, y, *means_low3, *cov3)
     weights = gauss_high + gauss_low + gauss_high2 + gauss_low2 + \
         gauss_high3 + gauss_low3  # Combine to create the "true" STRF
 
@@ -74,33 +87,55 @@ def generate_trf(fs_eeg):
     # Normalize the TRF energy to 1
     weights /= np.linalg.norm(weights)
 
+    # The TRF is cached and shared by the callers, so it is read only.
+    weights.setflags(write=False)
+    delays_sec.setflags(write=False)
+
     return weights, delays_sec
 
 
+@functools.lru_cache(maxsize=8)
+def trf_kernel_rfft(fs_eeg, n):
+    '''
+    The rfft of the TRF kernel in n points.
+    The kernel is fixed for the fs_eeg, so it is computed once for the same n.
+    '''
+    trf_kernel, _ = generate_trf(fs_eeg)
+    return np.fft.rfft(trf_kernel, n)
+
+
 def generate_simulation(freq, length, fs_sti):
     '''
     freq: The freq of flipping in sin waveform.
-    frame_rate: The frame rate of display.
     length: The total length of simulation in seconds.
+    fs_sti: The sampling rate of the simulation, e.g. the frame rate of display.
     '''
     times = np.arange(0, length, 1/fs_sti)
     time_series = np.sin(2 * np.pi * freq * times)
     return time_series, times
 
 
-def align_simulation_with_eeg_fs(time_series, times, fs_eeg):
-    aligned_times = np.arange(0, times[-1], 1/fs_eeg)
-    aligned_time_series = np.interp(aligned_times, times, time_series)
-    return aligned_time_series, aligned_times
-
-
-def generate_eeg_response(time_series, times, fs_eeg):
-    aligned_time_series, aligned_times = align_simulation_with_eeg_fs(
-        time_series, times, fs_eeg)
+def generate_eeg_response(freq, length, fs_eeg):
+    '''
+    freq: The freq of flipping in sin waveform.
+    length: The total length of simulation in seconds.
+    fs_eeg: The EEG recording frequency.
+    '''
+    # Sample the stimulus at the EEG frequency directly, instead of interpolating the display frames.
+    aligned_time_series, aligned_times = generate_simulation(
+        freq, length, fs_eeg)
     trf_kernel, trf_kernel_times = generate_trf(fs_eeg)
 
-    # Convolve aligned_time_series with weights
-    eeg_response = np.convolve(aligned_time_series, trf_kernel, mode='same')
+    # Convolve aligned_time_series with weights in the frequency domain.
+    # It equals np.convolve(aligned_time_series, trf_kernel, mode='same'),
+    # but costs O(n log n) with the cached kernel spectrum.
+    n_x, n_k = len(aligned_time_series), len(trf_kernel)
+    n = n_x + n_k - 1
+    eeg_response = np.fft.irfft(
+        np.fft.rfft(aligned_time_series, n) * trf_kernel_rfft(fs_eeg, n), n)
+    # The 'same' mode centers the output on the shorter of the two inputs.
+    start = (min(n_x, n_k) - 1) // 2
+    eeg_response = eeg_response[start:start+max(n_x, n_k)]
     # Align the response to the head
     eeg_response = eeg_response[:len(aligned_times)]
     eeg_times = aligned_times
@@ -112,51 +147,81 @@ def add_noise(array):
     return array + np.random.normal(0, 0.01, array.shape)
 
 
-def mk_eeg_response(freq):
+@functools.lru_cache(maxsize=64)
+def mk_clean_eeg_response(freq):
     '''
-    Make the eeg response for the given $freq.
+    Make the noiseless eeg response for the given $freq.
+    The response only depends on the $freq, so it is computed once for the same $freq.
 
     Args:
         - freq (float): The stimuli frequency.
 
     Returns:
-        - sliced_data: The eeg response, shape is (n_time_points, n_channels).
+        - eeg_response: The noiseless eeg response, shape is (n_time_points, ).
     '''
-    # The display fps.
-    fs_sti = 100
     # Generate $length seconds data in total.
     length = 5
     # Crop the time to (0, 4) seconds.
     max_time = 4
-    # How many channels of the EEG device.
-    channels = CONF['eeg']['channels']
     # The EEG recording frequency.
     fs_eeg = CONF['eeg']['sample_rate']
 
-    # Generate the display time series.
-    time_series, times = generate_simulation(freq, length, fs_sti)
-    # Generate the EEG data, the length is as the same as the $time_series.
+    # Generate the EEG data of the stimulus.
     eeg_response, eeg_times, trf_kernel, trf_kernel_times = generate_eeg_response(
-        time_series, times, fs_eeg)
+        freq, length, fs_eeg)
 
     # Crop into $max_time seconds.
-    valid_indices = times <= max_time
-    time_series = time_series[valid_indices]
-    times = times[valid_indices]
-    valid_indices = eeg_times <= max_time
-    eeg_response = eeg_response[valid_indices]
-    eeg_times = eeg_times[valid_indices]
+    eeg_response = eeg_response[eeg_times <= max_time]
+    eeg_response.setflags(write=False)
+
+    return eeg_response
+
+
+def mk_eeg_response(freq):
+    '''
+    Make the eeg response for the given $freq.
 
-    # Shape is [n_channels, n_times]
-    eeg_data = np.array([add_noise(eeg_response) for _ in range(channels)])
+    Args:
+        - freq (float): The stimuli frequency.
+
+    Returns:
+        - sliced_data: The eeg response, shape is (n_time_points, n_channels).
+    '''
+    # How many channels of the EEG device.
+    channels = CONF['eeg']['channels']
+
+    eeg_response = mk_clean_eeg_response(freq)
+
+    # Add the noise to every channel at once.
+    # Shape is [n_times, n_channels]
+    eeg_data = eeg_response[:, np.newaxis] + \
+        _RNG.normal(0, 0.01, (len(eeg_response), channels))
 
     # Slice the output into array.
     # n_times length array for (n_channels, ) np.array
-    sliced_data = [e.squeeze() for e in eeg_data.T]
+    sliced_data = list(eeg_data)
 
     return sliced_data
 
 
+@functools.lru_cache(maxsize=16)
+def _eeg_template_for(freq):
+    '''
+    Make the noiseless ssvep template for the given $freq.
+    It is float32 and in the reversed time order, as the ssvep chunk is played.
+
+    Args:
+        - freq (float): The stimuli frequency.
+
+    Returns:
+        - template: The read-only template, shape is (n_time_points, ).
+    '''
+    template = np.ascontiguousarray(
+        mk_clean_eeg_response(freq)[::-1], dtype=np.float32)
+    template.setflags(write=False)
+    return template
+
+
 def uint8(x):
     """Convert x into uint8
 
@@ -189,7 +254,7 @@ def convert_data_into_array(input_data: list, package_interval: float, time_reso
         - time_resolution: The time resolution of the package's time points.
 
     Returns:
-        - data: The data being converted, the shape is (n_channels, n_data_slices).
+        - data: The data being converted, the shape is (n_data_slices, n_channels).
         - times: The times for the data slices.
     '''
 
@@ -197,44 +262,20 @@ def convert_data_into_array(input_data: list, package_interval: float, time_reso
     n = len(input_data)
     # Compute the $corrected_last_time, it is assumed to be the time of the data's last time point.
     # ! I need the $ts is always larger than $y1, so the nearest point refers the least delayed data point being transferred.
-    y1 = np.array(range(n)) * package_interval
-    ts = np.array([e[1] for e in input_data])
+    y1 = np.arange(n) * package_interval
+    ts = np.fromiter((e[1] for e in input_data), dtype=np.float64, count=n)
     d = np.min(ts-y1)
-    corrected_last_time = (y1 + d)[-1]
-
-    # Concatenate the data and assign the time points.
-    data = np.array(np.concatenate([e[2].T for e in input_data], axis=0))
+    corrected_last_time = y1[-1] + d
+
+    # Fill the data into the preallocated array and assign the time points.
+    # The shape of the package is (n_channels, package_length).
+    channels, package_length = input_data[0][2].shape
+    data = np.empty((n * package_length, channels),
+                    dtype=input_data[0][2].dtype)
+    for i, e in enumerate(input_data):
+        data[i*package_length:(i+1)*package_length] = e[2].T
     m = len(data)
-    times = np.array([corrected_last_time-j*time_resolution for j in range(m)])
-
-    return data, times
-
-    def _mix_time_with_nan(t, n):
-        '''
-        The output is time series with two ends are marked with times,
-        others are nans.
-        The package length is package_length.
-
-        |t-package_length ------------------- t|
-        |<---------- package_length ---------->|
-
-        Args:
-            - t is the package arriving time.
-            - n is the length of the package.
-        '''
-        d = np.zeros(n, )
-        d.fill(np.nan)
-        d[-1] = t
-        d[0] = t - package_interval + time_resolution
-        return d
-
-    # The data shape is (n_time_points, n_channels)
-    data = np.concatenate([d.T for i, t, d in input_data])
-    times = np.concatenate([_mix_time_with_nan(t, d.shape[1])
-                           for i, t, d in input_data])
-
-    # Linear interpolate the times array
-    times = interpolate_nan(times)
+    times = corrected_last_time - np.arange(m, dtype=np.float64) * time_resolution
 
     return data, times
 
@@ -255,14 +296,39 @@ class EEGDeviceReader(object):
     time_resolution = 1 / sample_rate
 
     rlock = RLock()
-    ssvep_chunk_data = []
+    # The ssvep chunk template of (channels x n_time_points) in float32, None if not available.
+    ssvep_chunk_data = None
 
     def __init__(self):
         self.conf_override()
         self.running = False
-
-        LOGGER.debug(
-            'Initialize {} with {}'.format(self.__class__, self.__dict__))
+        # It is set to stop the reading loop.
+        self._stop_event = Event()
+        # The ssvep chunk being played, and how many time points of it are played.
+        self._ssvep_playing = None
+        self._ssvep_cursor = 0
+
+        # The data buffer is the ring of the packages in the SoA layout.
+        # The package of the ring's slot is (idx, timestamp, data of (channels x package_length)).
+        # The slot is written at self._head % self.packages_limit, the oldest package is overwritten.
+        # The data is stored in float32, it is enough for the display and the decoding,
+        # and it halves the memory traffic. The timestamps are kept in float64.
+        self._data_ring = np.empty(
+            (self.packages_limit, self.channels, self.package_length), dtype=np.float32)
+        self._ts_ring = np.empty(self.packages_limit, dtype=np.float64)
+        self._idx_ring = np.empty(self.packages_limit, dtype=np.int64)
+        self._head = 0
+        # It is notified when the new package is pushed into the ring.
+        self._new_package_cv = Condition()
+        # The time offsets of the time points in the package.
+        self._col_offsets = np.arange(self.package_length) / self.sample_rate
+        # The scratch buffers of the incoming package, they are reused across the packages.
+        self._time_row = np.empty(self.package_length, dtype=np.float64)
+        self._incoming = np.empty(
+            (self.channels, self.package_length), dtype=np.float32)
+
+        LOGGER.opt(lazy=True).debug(
+            'Initialize {} with {}', lambda: self.__class__, lambda: self.__dict__)
         pass
 
     def conf_override(self):
@@ -274,6 +340,9 @@ class EEGDeviceReader(object):
 
         self.package_interval = self.package_length / \
             self.sample_rate  # Interval between packages
+        # The display offsets of the channels, it is added to the (channels x times) data.
+        self._offset_col = np.arange(
+            self.channels, dtype=np.float32).reshape(-1, 1)
 
         LOGGER.debug('Override the options with CONF')
 
@@ -285,6 +354,7 @@ class EEGDeviceReader(object):
 
     def stop(self):
         self.running = False
+        self._stop_event.set()
 
     @contextlib.contextmanager
     def lock(self):
@@ -295,20 +365,31 @@ class EEGDeviceReader(object):
             self.rlock.release()
 
     def fill_ssvep_chunk_data(self, freq):
-        d = mk_eeg_response(freq)
-        with self.lock():
-            self.ssvep_chunk_data = d
-        LOGGER.debug(
-            f'Make pseudo ssvep chunk data: {len(self.ssvep_chunk_data)}, {self.ssvep_chunk_data[0].shape}')
+        # The template is played in the reversed time order,
+        # as the time points were popped from the tail of the list.
+        # The clean template is cached on the freq, only the noise is drawn for every chunk,
+        # the same as mk_eeg_response(freq) does.
+        clean = _eeg_template_for(freq)
+        template = _RNG.standard_normal(
+            (self.channels, len(clean)), dtype=np.float32)
+        template *= 0.01
+        template += clean
+        # Swap the reference at once, the template is never mutated after it is published.
+        self.ssvep_chunk_data = template
+        LOGGER.opt(lazy=True).debug(
+            'Make pseudo ssvep chunk data: {}', lambda: template.shape)
 
     def _read_data(self):
         """Simulate the EEG device reading,
         it is called by the self.run_forever() method.
         """
 
-        self.data_buffer = []
+        self._head = 0
         self._read_data_idx = 0
 
+        # The monotonic deadline of the next package, the wall clock only stamps the packages.
+        next_tick = time.monotonic()
+
         LOGGER.debug('Read data loop starts.')
         while self.running:
             # Record the loop start time.
@@ -316,35 +397,47 @@ class EEGDeviceReader(object):
 
             # Simulation the incoming signal.
             # The shape is (n_channels, n_time_points).
-            incoming = np.zeros((self.channels, self.package_length)) + t
-            for j in range(self.package_length):
-                incoming[:, j] += j / self.sample_rate
-                incoming[:, j] %= 1
+            # The time row is computed in float64, since float32 can not resolve the fraction of the timestamp,
+            # and it is converted into float32 when it fills the incoming.
+            incoming = self._incoming
+            np.add(self._col_offsets, t, out=self._time_row)
+            np.mod(self._time_row, 1, out=self._time_row)
+            incoming[:] = self._time_row
 
             # Use the ssvep_chunk_data if it is available.
             # It overwrites the incoming variable.
-            with self.lock():
-                for j in range(self.package_length):
-                    if len(self.ssvep_chunk_data) > 0:
-                        incoming[:, j] = self.ssvep_chunk_data.pop()
-
-            # Push the processed incoming data.
-            # ! The format of the data_buffer's element is (i, t, d)
-            # ! The shape of d is (n_channels, n_time_points).
-            self.data_buffer.append((self._read_data_idx, t, incoming))
+            # The chunk is read from the local reference without the lock,
+            # the new chunk replaces the reference and restarts the cursor.
+            chunk = self.ssvep_chunk_data
+            if chunk is not self._ssvep_playing:
+                self._ssvep_playing = chunk
+                self._ssvep_cursor = 0
+            if chunk is not None:
+                cursor = self._ssvep_cursor
+                k = min(self.package_length, chunk.shape[1] - cursor)
+                if k > 0:
+                    incoming[:, :k] = chunk[:, cursor:cursor+k]
+                    self._ssvep_cursor = cursor + k
+
+            # Push the processed incoming data into the ring.
+            # ! The shape of the data is (n_channels, n_time_points).
+            # The head moves after the slot is written, so the readers only see the complete packages.
+            slot = self._head % self.packages_limit
+            self._data_ring[slot] = incoming
+            self._ts_ring[slot] = t
+            self._idx_ring[slot] = self._read_data_idx
+            with self._new_package_cv:
+                self._head += 1
+                self._new_package_cv.notify_all()
             self._read_data_idx += 1
 
-            # Prevent the buffer size from being too large.
-            if self.get_data_buffer_size() > self.packages_limit:
-                LOGGER.warning(
-                    'Data buffer exceeds {} packages.'.format(self.packages_limit))
-                self.data_buffer.pop(0)
-
-            # How long is passed since the loop starts.
-            delay = time.time() - t
-
             # Make sure the next loop starts after $self.package_interval seconds.
-            time.sleep(max(0.001, self.package_interval - delay))
+            # If the loop falls behind, it starts at once without catching up.
+            # The waiting is interrupted at once when the reader stops.
+            now = time.monotonic()
+            next_tick = max(next_tick + self.package_interval, now)
+            if self._stop_event.wait(next_tick - now):
+                break
 
         LOGGER.debug('Read data loop stops.')
 
@@ -358,17 +451,73 @@ class EEGDeviceReader(object):
         Returns:
             2d array: The data with offset
         """
-        for j, d in enumerate(data):
-            d += j
+        data += self._offset_col
         return data
 
     def get_data_buffer_size(self):
-        """Get the current buffer size for the data_buffer
+        """Get the current buffer size for the data ring
 
         Returns:
             int: The buffer size.
         """
-        return len(self.data_buffer)
+        return min(self._head, self.packages_limit)
+
+    def latest_timestamp(self):
+        """The timestamp of the latest package, -inf if there is no package yet."""
+        head = self._head
+        if head < 1:
+            return -np.inf
+        return self._ts_ring[(head - 1) % self.packages_limit]
+
+    def wait_for_package_after(self, t: float, timeout: float = 0.5):
+        """Block until the package later than the timestamp $t arrives.
+
+        The waiting thread is woken up by the new package, instead of polling the buffer.
+
+        Args:
+            t (float): The timestamp.
+            timeout (float, optional): The seconds to recheck in case of missing the notification. Defaults to 0.5.
+        """
+        with self._new_package_cv:
+            while self.latest_timestamp() <= t:
+                self._new_package_cv.wait(timeout)
+
+    def peek_latest_array(self, length=50):
+        """Peek the latest data in the data ring with given length in packages.
+
+        The data is the view of the ring if it does not wrap around, otherwise it is copied.
+        The view is valid until the ring is overwritten, which takes self.packages_limit packages.
+
+        If there is no data available, return None.
+
+        Args:
+            length (int, optional): How many packages are required. Defaults to 50.
+
+        Returns:
+            tuple: The (data, timestamps, indices) of the packages.
+                The shape of data is (length, self.channels, self.package_length).
+            None if there is no data available.
+        """
+        head = self._head
+        size = min(head, self.packages_limit)
+        if size < 1:
+            return None
+
+        length = min(length, size)
+        start = (head - length) % self.packages_limit
+        stop = start + length
+
+        # The packages are contiguous in the ring.
+        if stop <= self.packages_limit:
+            return (self._data_ring[start:stop],
+                    self._ts_ring[start:stop],
+                    self._idx_ring[start:stop])
+
+        # The packages wrap around the end of the ring.
+        stop -= self.packages_limit
+        return (np.concatenate((self._data_ring[start:], self._data_ring[:stop])),
+                np.concatenate((self._ts_ring[start:], self._ts_ring[:stop])),
+                np.concatenate((self._idx_ring[start:], self._idx_ring[:stop])))
 
     def peek_latest_data_by_length(self, length=50):
         """Peek the latest data in the self.data_buffer with given length in packages.
@@ -382,10 +531,12 @@ class EEGDeviceReader(object):
             list: The data being fetched. The elements of the list are (idx, timestamp, data of (self.channels x self.package_length)).
             None if there is no data available.
         """
-        if self.get_data_buffer_size() < 1:
+        latest = self.peek_latest_array(length)
+        if latest is None:
             return None
 
-        output = [e for e in self.data_buffer[-length:]]
+        data, ts, idx = latest
+        output = list(zip(idx.tolist(), ts.tolist(), data))
 
         return output
 
@@ -399,6 +550,7 @@ class EEGDeviceReader(object):
         """Run the loops forever.
         """
         self.running = True
+        self._stop_event.clear()
         Thread(target=self._read_data, daemon=True).start()
         pass
 
@@ -151,13 +151,13 @@ def init():
 def animate(i_frame):
     client.send_message(f'Info. Display {i_frame} frame.')
 
-    e = eeg_device_reader.peek_latest_data_by_length(50)
-    first = e[0]
-    last = e[-1]
-    print(first[0], last[0], first[1], last[1],
-          last[1]-first[1], first[2].shape, len(e))
+    # The shape of arr is (n_packages, n_channels, package_length).
+    arr, ts, idx = eeg_device_reader.peek_latest_array(50)
+    print(idx[0], idx[-1], ts[0], ts[-1],
+          ts[-1]-ts[0], arr[0].shape, len(arr))
 
-    y2 = np.concatenate([d[2] for d in e], axis=1)
+    # Lay the packages side by side, the shape is (n_channels, n_time_points).
+    y2 = arr.transpose(1, 0, 2).reshape(arr.shape[1], -1)
     x2 = np.linspace(0, 1, y2.shape[1])
     for i in range(65):
         channel_lines[i][0].set_data(x2, y2[i]+i)
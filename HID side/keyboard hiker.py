@@ -22,12 +22,13 @@ import tkinter
 from tkinter import ttk
 
 import sys
-import json
+import orjson
 import time
+import heapq
 import keyboard
 import argparse
 
-from threading import Thread
+from threading import Thread, Condition
 from loguru import logger
 from rich import print, inspect
 
@@ -50,14 +51,14 @@ class MyClient(BaseClientSocket):
 
     def handle_message(self, message):
         super().handle_message(message)
-        letter = json.loads(message)
+        letter = orjson.loads(message)
         # Stamp the letter.
         letter['_stations'].append((self.path_uid, time.time()))
         # Mark the letter as finished.
         if lt := self.mm.bag_pending.fetch_letter(letter['uid']):
             lt.update({'_finished_at': time.time()})
-            self.mm.bag_finished.insert_letter(letter)
-            self.mm.bag_finished.insert_letter(lt)
+            self.mm.bag_finished.insert_letter(letter, copy=False)
+            self.mm.bag_finished.insert_letter(lt, copy=False)
         return
 
 
@@ -70,6 +71,9 @@ class GUI(tkinter.Tk):
     label = None
     detail = None
     font_family = 'Courier'  # 'Helvetica'
+    # The latest key event, it is set by the keyboard thread.
+    pending_event = None
+    refresh_interval_ms: int = 33
 
     def __init__(self):
         super().__init__()
@@ -93,8 +97,17 @@ class GUI(tkinter.Tk):
 
         self.label = label
         self.detail = detail
+        self.after(self.refresh_interval_ms, self._drain_pending)
         logger.debug('Initialized')
 
+    def _drain_pending(self):
+        '''Refresh the label with the latest key event, it runs in the Tk thread.'''
+        if pending := self.pending_event:
+            self.pending_event = None
+            event, event_time, count = pending
+            self.label.config(text=f'{event}\n{event_time}\nCount: {count}')
+        self.after(self.refresh_interval_ms, self._drain_pending)
+
 
 class KeyboardHiker(object):
     # Flags
@@ -170,32 +183,68 @@ class KeyboardHiker(object):
             inspect(event)
 
         # Update the gui, if it is enabled.
+        # The label is refreshed by the gui's polling, Tk is not thread-safe.
         if self.gui:
-            self.gui.label.config(
-                text=f'{event}\n{event.time}\nCount: {self.count}')
+            self.gui.pending_event = (event, event.time, self.count)
 
         # Logging.
-        logger.debug(f'Got key press: {event}, {event.time}')
+        logger.opt(lazy=True).debug(
+            'Got key press: {}, {}', lambda: event, lambda: event.time)
 
         # Send ssvep_chunk_start event to the /eeg/monitor
         content = f'Keyboard event: {event}'
         dst = '/client/simulationWorkload'
         letter = client.mm.mk_letter(
             src=client.path_uid, dst=dst, content=content)
-        client.send_message(json.dumps(letter))
+        client.send_message(orjson.dumps(letter))
         client.mm.bag_pending.insert_letter(letter)
-        Thread(target=mark_as_expired, args=(
-            letter['uid'],), daemon=True).start()
+        expiry_watcher.watch(letter['uid'])
+
+
+class ExpiryWatcher(object):
+    '''
+    Mark the pending letters as expired in a single thread.
+    The uids are kept in a heap ordered by their deadlines,
+    so the keypress does not spawn a sleeping thread for every letter.
+    '''
+    expire_after: float = 5
+
+    def __init__(self):
+        self.heap = []
+        self.cv = Condition()
+        Thread(target=self._loop, daemon=True).start()
+
+    def watch(self, uid: str):
+        '''
+        Watch the uid, it expires after the expire_after seconds.
+
+        :param uid: The uid of the pending letter.
+        '''
+        with self.cv:
+            heapq.heappush(
+                self.heap, (time.monotonic() + self.expire_after, uid))
+            self.cv.notify()
+
+    def _loop(self):
+        while True:
+            with self.cv:
+                # Wait until the earliest deadline is reached.
+                while not self.heap or (delay := self.heap[0][0] - time.monotonic()) > 0:
+                    self.cv.wait(None if not self.heap else delay)
+                _, uid = heapq.heappop(self.heap)
+            mark_as_expired(uid)
 
 
 def mark_as_expired(uid):
-    time.sleep(5)
     if letter := client.mm.bag_pending.fetch_letter(uid):
         letter.update({'_fail_reason': 'Expired'})
-        client.mm.bag_failed.insert_letter(letter)
+        client.mm.bag_failed.insert_letter(letter, copy=False)
         logger.error(f'Expired: {letter}')
 
 
+expiry_watcher = ExpiryWatcher()
+
+
 # %% ---- 2024-11-15 ------------------------
 # Play ground
 if __name__ == "__main__":
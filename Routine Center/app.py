@@ -1,21 +1,78 @@
+import os
 import time
-import json
+import orjson
 import socket
+import struct
+import selectors
 import threading
-import pandas as pd
+import contextlib
+import numpy as np
 import tkinter as tk
 
 from loguru import logger
-from tqdm.auto import tqdm
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from client_base import RouteIndex, dumps_letter_head, frame_header, sendmsg_all, tune_socket
 
 logger.add('log/BCI station control center.log', rotation='5 MB')
 
+# The precompiled 8 bytes big-endian length header of the frame, for packing and unpacking.
+_LENGTH = struct.Struct('>Q')
+
+# The flags creating the non-blocking and non-inheritable socket at once, where they are available (Linux).
+_SOCK_FLAGS = getattr(socket, 'SOCK_NONBLOCK', 0) | getattr(socket, 'SOCK_CLOEXEC', 0)
+
+
+def create_server_socket():
+    '''
+    Create the non-blocking and non-inheritable TCP socket for the server.
+    The flags are applied at creation where they are available,
+    otherwise they are set on the created socket.
+
+    :return: The server socket.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM | _SOCK_FLAGS)
+    if not getattr(socket, 'SOCK_NONBLOCK', 0):
+        sock.setblocking(False)
+    if not getattr(socket, 'SOCK_CLOEXEC', 0):
+        os.set_inheritable(sock.fileno(), False)
+    return sock
+
+
+class ClientState:
+    '''
+    The receiving state of the client socket in the selector.
+    The received bytes are buffered until the complete frames are consumed.
+    '''
+
+    def __init__(self, client_socket, client_address):
+        self.socket = client_socket
+        self.address = client_address
+        # The received bytes not consumed yet.
+        self.buffer = bytearray()
+        # Whether the client provided the valid key.
+        self.authorized = False
+        # The identity of the client, it is known after the first message.
+        self.path = None
+        self.uid = None
+        # The messages arrived among the echo responses, they are handled after the greeting.
+        self.pending = []
+        # The frames not sent yet, they are flushed when the socket is writable.
+        # The lock serializes the senders, the letters are forwarded from the selector and the greeting threads.
+        self.outbox = bytearray()
+        self.send_lock = threading.Lock()
+
 
 class ControlCenter:
     host = 'localhost'
     port = 12345
     valid_key = b'12345678'
+    # The socket buffer size in bytes, e.g. 4 * 1024 * 1024.
+    # None keeps the kernel's autotuning.
+    socket_buffer_size = None
+    # The seconds waiting for the next echo response.
+    echo_timeout = 0.5
 
     def __init__(self, host=None, port=None, valid_key=None):
         if host:
@@ -25,227 +82,376 @@ class ControlCenter:
         if valid_key:
             self.valid_key = valid_key
 
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket = create_server_socket()
+        tune_socket(self.server_socket, self.socket_buffer_size)
+        self.sel = selectors.DefaultSelector()
+        # The bounded workers greeting the new clients.
+        self._pool = ThreadPoolExecutor(
+            max_workers=64, thread_name_prefix='bci-client')
         self.clients = {}
+        # The measured clients indexed by their path and uid, for routing the letters.
+        self.routes = RouteIndex()
         self.gui = None
+        # The UI components of the clients, only touched in the Tkinter thread.
+        # The element is (frame, latest_message, messages).
+        self.client_frames = {}
+        self._tkUI_refresh_pending = False
         self.echo_data = []
+        # The message handlers by the verb of the message.
+        self._handlers = {
+            b'Echo': self._on_echo,
+            b'Keep-Alive': self._on_keep_alive,
+            b'{': self._on_letter,
+        }
         logger.info(f"Initialized control center {self}")
 
     def start_server(self):
-        """Start the server and begin accepting clients."""
+        """Start the server and begin serving clients with the selector."""
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        self.sel.register(self.server_socket, selectors.EVENT_READ)
         logger.info(f"Server started on {self.host}:{self.port}")
-        threading.Thread(target=self.accept_clients, daemon=True).start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        """
+        Dispatch the socket events in a single thread.
+        The server socket accepts new clients,
+        and the client sockets receive the messages.
+        """
+        while True:
+            try:
+                # The timeout makes sure the sockets registered by other threads are selected in time.
+                events = self.sel.select(timeout=1)
+            except (OSError, ValueError):
+                # The selector has been closed with the server.
+                break
+
+            for key, mask in events:
+                if key.fileobj is self.server_socket:
+                    self.accept_clients()
+                    continue
+                # Flush the buffered frames first, skip the client if it is closed.
+                if mask & selectors.EVENT_WRITE and not self.flush_client(key.data):
+                    continue
+                if mask & selectors.EVENT_READ:
+                    self.handle_client(key.data)
 
     def accept_clients(self):
         """Accept incoming client connections."""
         while True:
-            client_socket, client_address = self.server_socket.accept()
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except BlockingIOError:
+                # No more pending connections.
+                return
+            tune_socket(client_socket, self.socket_buffer_size)
+            # The accepted socket is already non-inheritable (accept4 with SOCK_CLOEXEC),
+            # but it does not inherit the non-blocking mode of the server socket.
+            client_socket.setblocking(False)
             logger.info(f"Client {client_address} connected")
-            threading.Thread(target=self.handle_client, args=(
-                client_socket, client_address)).start()
+            self.sel.register(client_socket, selectors.EVENT_READ,
+                              ClientState(client_socket, client_address))
 
-    def handle_client(self, client_socket, client_address):
-        """Handle communication with a connected client."""
+    def handle_client(self, state):
+        """Receive the available bytes from the client and consume the complete frames."""
         try:
-            # Receive the hello message from the client.
-            # Read the advanced key code (8 bytes) for identifying the legal client.
-            key_code = client_socket.recv(8)
-            if key_code != self.valid_key:
-                logger.warning(
-                    f"Client {client_address} provided invalid key. Disconnecting.")
-                client_socket.close()
-                return
+            data = state.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, ConnectionAbortedError) as err:
+            logger.error(f'Occurred: {err}')
+            data = b''
 
-            # Read the length of the initial message (8 bytes for larger messages)
-            message_length = client_socket.recv(8)
-            if not message_length:
-                return
-            message_length = int.from_bytes(message_length, byteorder='big')
-
-            # Read the actual message based on the length
-            message = b""
-            while len(message) < message_length:
-                chunk = client_socket.recv(
-                    min(message_length - len(message), 1024))
-                if not chunk:
-                    return
-                message += chunk
-
-            # Not allow the empty message body.
-            assert message, "Empty message is not allowed."
-
-            # The message body contains the identity.
-            message = message.decode()
-            logger.debug(
-                f"Received message: {message[:20]} ({len(message)} bytes)")
-            client_info = message.split(',')
-            client_path = client_info[0]
-            client_uid = client_info[1]
-
-            # New client is coming.
-            # Add into the client_list,
-            # Update its status.
-            self.clients[client_address] = {
-                # Basic information of the socket.
-                'address': client_address,
-                'socket': client_socket,
-                'path': client_path,
-                'uid': client_uid,
-                # The UI components for the socket.
-                'frame': None,
-                'latest_message': tk.StringVar(),
-                'messages': tk.IntVar(),
-                # The connection quality of the socket.
-                # The netRemoteTime and netLocalTime is used to convert between the remote time and the local time.
-                # Estimated delay of transaction.
-                'netDelay': None,
-                # The remote timestamp.
-                'netRemoteTime': None,
-                # The local timestamp.
-                'netLocalTime': None
-            }
+        # The client is gone.
+        if not data:
+            self.close_client(state)
+            return
 
-            # Echo package chunk.
-            self.send_echo_packages(client_socket, client_address)
+        state.buffer.extend(data)
 
-            self.update_client_list_tkUI()
+        # The failure of one client must not stop the selector serving the others.
+        try:
+            self.consume_frames(state)
+        except Exception as err:
+            logger.error(f'Occurred: {err}')
+            self.close_client(state)
 
-            logger.info(f'Client {self.clients[client_address]} comes.')
+    def consume_frames(self, state):
+        """
+        Consume the complete frames in the receiving buffer of the client.
+        The incomplete frame is left in the buffer until the rest bytes arrive.
+        """
+        buffer = state.buffer
 
-            # Keep listening for the messages from the client.
-            while True:
-                # Receive the header
-                # The header is message length
-                message_length = client_socket.recv(8)
-                # Break out if message_length is null
-                if not message_length:
+        # Read the advanced key code (8 bytes) for identifying the legal client.
+        if not state.authorized:
+            if len(buffer) < 8:
+                return
+            if buffer[:8] != self.valid_key:
+                logger.warning(
+                    f"Client {state.address} provided invalid key. Disconnecting.")
+                self.close_client(state)
+                return
+            del buffer[:8]
+            state.authorized = True
+
+        # Parse the frames on the view of the buffer without copying,
+        # and drop the consumed bytes at once.
+        consumed = 0
+        identity = None
+        with memoryview(buffer) as view:
+            while len(buffer) - consumed >= 8:
+                # The header is message length.
+                message_length, = _LENGTH.unpack_from(view, consumed)
+                end = consumed + 8 + message_length
+
+                # Wait for the rest of the message body.
+                if len(buffer) < end:
                     break
-                message_length = int.from_bytes(
-                    message_length, byteorder='big')
-
-                # Receive the message body on message_length.
-                message = b""
-                while len(message) < message_length:
-                    chunk = client_socket.recv(
-                        min(message_length - len(message), 1024))
-                    if not chunk:
-                        break
-                    message += chunk
+
+                message = bytes(view[consumed+8:end])
+                consumed = end
 
                 # Not allow the empty message body.
                 assert message, "Empty message is not allowed."
 
-                message = message.decode()
-                logger.debug(
-                    f"Received message: {message[:20]} ({len(message)} bytes)")
+                logger.opt(lazy=True).debug(
+                    "Received message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
 
-                self.handle_message(message, client_address)
+                # The first message body contains the identity.
+                # The rest frames are consumed after the echo packages.
+                if state.path is None:
+                    identity = message.decode()
+                    break
 
-                # The next while loop.
-                continue
+                self.handle_message(message, state.address)
+
+        del buffer[:consumed]
+
+        if identity is not None:
+            self.identify_client(state, identity)
+
+    def identify_client(self, state, message: str):
+        """Register the new client with the identity [message], and start greeting it."""
+        client_info = message.split(',')
+        state.path = client_info[0]
+        state.uid = client_info[1]
+
+        # New client is coming.
+        # Add into the client_list,
+        # Update its status.
+        self.clients[state.address] = {
+            # Basic information of the socket.
+            'address': state.address,
+            'socket': state.socket,
+            'state': state,
+            'path': state.path,
+            'uid': state.uid,
+            # The UI components for the socket.
+            'frame': None,
+            'latest_message': b'',
+            'messages': 0,
+            # The connection quality of the socket.
+            # The netRemoteTime and netLocalTime is used to convert between the remote time and the local time.
+            # Estimated delay of transaction.
+            'netDelay': None,
+            # The remote timestamp.
+            'netRemoteTime': None,
+            # The local timestamp.
+            'netLocalTime': None
+        }
+
+        # The echo packages are exchanged on the blocking socket,
+        # so the client leaves the selector until the greeting is finished.
+        self.sel.unregister(state.socket)
+        self._pool.submit(self.greet_client, state)
+
+    def greet_client(self, state):
+        """Measure the connection quality of the new client, and hand it back to the selector."""
+        try:
+            state.socket.setblocking(True)
 
-        except (ConnectionResetError, ConnectionAbortedError, AssertionError) as err:
-            logger.error(f'Occurred: {err}')
+            # Echo package chunk.
+            self.send_echo_packages(state)
+
+            # The frames sent from now on are buffered if the client can not take them at once.
+            state.socket.setblocking(False)
+
+            # The letters are routed to the client after its timestamps can be translated.
+            self.routes.add(state.path, state.uid, self.clients[state.address])
 
-        finally:
-            client_socket.close()
-            del self.clients[client_address]
             self.update_client_list_tkUI()
-            self.update_latest_message(
-                client_address, f"{client_path} ({client_uid}) disconnected")
 
-    def handle_message(self, message, client_address):
-        meaningful_message = False
+            logger.info(f'Client {self.clients[state.address]} comes.')
 
-        src_client = self.clients[client_address]
+            # Handle the messages arrived among the echo responses,
+            # consume the frames arrived after them,
+            # and keep listening for the messages from the client.
+            pending, state.pending = state.pending, []
+            for message in pending:
+                self.handle_message(message, state.address)
+            self.consume_frames(state)
+            # The frames buffered before the registration are flushed by the selector.
+            with state.send_lock:
+                self.sel.register(state.socket, self._client_events(state), state)
 
-        # TODO: Handle the message from the client
-        if message.startswith("Echo"):
-            # Handle echo package
-            # Handle the echo package AFTER the connection has been established.
-            # It is used to sync the client during the workflow.
-            parts = message.split(',')
-            t1 = float(parts[1])
-            t2 = float(parts[2])
-            t3 = time.time()
-            self.echo_data.append({'t1': t1, 't2': t2, 't3': t3})
-            logger.debug('Received echo message.')
-        elif message.startswith("Keep-Alive"):
-            # Handle keep-alive package.
-            # Not doing anything.
-            pass
-        elif message.startswith("{"):
-            # The incoming message is the json object
-            raw_letter = json.loads(message)
-
-            url = urlparse(raw_letter['dst'])
-            path = url.path
-            uid = url.query
-
-            raw_letter['_stations'].append(('ControlCenter', time.time()))
-
-            # Transfer it to the client with dst path
-            count = 0
-            for addr, dst_client in self.clients.items():
-                # Check if the dst_client matches with the letter's dst.
-                if dst_client['path'] == path and any((dst_client['uid'] == uid, len(uid) == 0)):
-                    # Make the new letter.
-                    letter = raw_letter.copy()
-                    # Translate the timestamp into dst's timestamp.
-                    t = letter['_timestamp']
-                    # Translate src time into local time
-                    t = t - src_client['netRemoteTime'] + \
-                        src_client['netLocalTime']
-                    # Translate local time into dst time
-                    t = t - dst_client['netLocalTime'] + \
-                        dst_client['netRemoteTime']
-                    letter['_timestamp'] = t
-                    self.send_message(dst_client['socket'], json.dumps(letter))
-                    logger.info(f'Translated {letter} to {addr}')
-                    count += 1
-
-            # If the letter is not delivered, log the warning.
-            if count == 0:
-                logger.warning(f'Received {raw_letter}, but did not deliver.')
-        else:
+        except Exception as err:
+            logger.error(f'Occurred: {err}')
+            self.close_client(state)
+
+    def close_client(self, state):
+        """Close the client connection and remove it from the client list."""
+        with contextlib.suppress(KeyError, ValueError):
+            self.sel.unregister(state.socket)
+        state.socket.close()
+
+        # The client has not been identified.
+        client_info = self.clients.pop(state.address, None)
+        if client_info is None:
+            return
+        self.routes.remove(state.path, state.uid, client_info)
+
+        self.update_client_list_tkUI()
+        logger.info(f"{state.path} ({state.uid}) disconnected")
+
+    def handle_message(self, message: bytes, client_address):
+        """
+        Dispatch the [message] to its handler.
+        The handler is looked up by the verb before the first comma,
+        or by the leading '{' of the json letter.
+        """
+        verb, _, rest = message.partition(b',')
+        handler = self._handlers.get(verb) or self._handlers.get(message[:1])
+
+        if handler is None:
             meaningful_message = True
-            logger.warning(f'Can not handle message: {message}')
+            logger.warning(f'Can not handle message: {message.decode()}')
+        else:
+            meaningful_message = handler(message, rest, client_address)
 
         # Update the latest message.
+        # The message is kept in bytes, it is decoded when the GUI shows it.
         self.update_latest_message(
-            client_address, message, meaningful_message=True)
+            client_address, message, meaningful_message=meaningful_message)
 
         return message
 
-    def send_echo_packages(self, client_socket, client_address):
+    def _on_echo(self, message: bytes, rest: bytes, client_address):
+        """
+        Handle the echo package AFTER the connection has been established.
+        It is used to sync the client during the workflow.
+        The [rest] is b't1,t2'.
+        """
+        comma = rest.index(b',')
+        t1 = float(rest[:comma])
+        t2 = float(rest[comma+1:])
+        t3 = time.perf_counter_ns()
+        self.echo_data.append({'t1': t1, 't2': t2, 't3': t3})
+        logger.debug('Received echo message.')
+        return False
+
+    def _on_keep_alive(self, message: bytes, rest: bytes, client_address):
+        """Handle keep-alive package, not doing anything."""
+        return False
+
+    def _on_letter(self, message: bytes, rest: bytes, client_address):
+        """Handle the json letter, transfer it to the clients with the dst path."""
+        src_client = self.clients[client_address]
+
+        # The incoming message is the json object
+        raw_letter = orjson.loads(message)
+
+        url = urlparse(raw_letter['dst'])
+        path = url.path
+        uid = url.query
+
+        raw_letter['_stations'].append(('ControlCenter', time.time()))
+
+        # The letter is dumped once, only the translated timestamp differs between the receivers.
+        head = None
+
+        # Transfer it to the client with dst path
+        count = 0
+        # The clients matching with the letter's dst are looked up in the index.
+        for dst_client in self.routes.lookup(path, uid):
+            addr = dst_client['address']
+            if head is None:
+                head = dumps_letter_head(raw_letter)
+            # Translate the timestamp into dst's timestamp.
+            t = raw_letter['_timestamp']
+            # Translate src time into local time
+            t = t - src_client['netRemoteTime'] + \
+                src_client['netLocalTime']
+            # Translate local time into dst time
+            t = t - dst_client['netLocalTime'] + \
+                dst_client['netRemoteTime']
+            letter = head + repr(t).encode() + b'}'
+            # The failure of the receiver must not close the sender,
+            # the broken receiver is closed when the selector reads it.
+            try:
+                self.send_message(dst_client['state'], letter)
+            except OSError as err:
+                logger.error(f'Failed to send letter to {addr}: {err}')
+                continue
+            logger.info(f'Translated {letter.decode()} to {addr}')
+            count += 1
+
+        # If the letter is not delivered, log the warning.
+        if count == 0:
+            logger.warning(f'Received {raw_letter}, but did not deliver.')
+        return True
+
+    def send_echo_packages(self, state):
         """
         Send and receive a chunk of echo packages.
 
         Attention, this methods duplicates 20 talks to prevent random delay occasionally.
-        There are 10 ms gaps between talks, so it costs about 0.2 seconds to finish.
+        The talks are pipelined, all the packages are sent back-to-back before receiving the responses.
+        Every response carries its own t1, so it costs about one round trip to finish.
+        The responses are gathered with a selector, so every arrived response is parsed at once.
         """
-        echo_data = []
-        for _ in tqdm(range(20), 'Echo'):
-            self.send_echo_package(client_socket)
-            self.receive_echo_response(client_socket, echo_data)
-            time.sleep(0.01)
-        df = pd.DataFrame(echo_data)
-        df['delay'] = df['t3'] - df['t1']
-        df['tServer'] = (df['t3'] + df['t1']) / 2
-        df['tClient'] = df['t2']
-        df = df.sort_values(by='delay', ascending=True)
-
+        client_socket = state.socket
+        for _ in range(20):
+            self.send_echo_package(state)
+
+        t1s, t2s, t3s = np.empty(20), np.empty(20), np.empty(20)
+        n = 0
+        with selectors.DefaultSelector() as sel:
+            sel.register(client_socket, selectors.EVENT_READ)
+            # Stop waiting if the client keeps silent for the timeout.
+            while n < 20 and sel.select(timeout=self.echo_timeout):
+                data = client_socket.recv(65536)
+                t3 = time.perf_counter_ns()
+                if not data:
+                    raise ConnectionResetError('Client closed during the echo')
+                state.buffer.extend(data)
+
+                for t1, t2 in self.receive_echo_responses(state)[:20-n]:
+                    t1s[n], t2s[n], t3s[n] = t1, t2, t3
+                    n += 1
+
+        if n == 0:
+            raise TimeoutError('No echo response is received')
+
+        # Use the talk with the lowest delay.
+        # The local times are in nanoseconds, convert them into seconds.
+        delays = t3s[:n] - t1s[:n]
+        i = int(np.argmin(delays))
+
+        # The netRemoteTime is the wall clock of the client,
+        # so the midpoint is converted into the wall clock with the anchor pair taken at once.
+        wall_anchor, perf_anchor = time.time(), time.perf_counter_ns()
         connection_quality = dict(
-            netDelay=float(df.iloc[0]['delay']),
-            netRemoteTime=float(df.iloc[0]['tClient']),
-            netLocalTime=float(df.iloc[0]['tServer'])
+            netDelay=float(delays[i]) / 1e9,
+            netRemoteTime=float(t2s[i]),
+            netLocalTime=wall_anchor +
+            (float(t3s[i] + t1s[i]) * 0.5 - perf_anchor) / 1e9
         )
-        self.clients[client_address].update(connection_quality)
-        return df
+        self.clients[state.address].update(connection_quality)
+        return connection_quality
 
-    def send_echo_package(self, client_socket):
+    def send_echo_package(self, state):
         """
         Send a single echo package to the client.
         The package is finished in 3 steps:
@@ -254,91 +460,182 @@ class ControlCenter:
             3. t3, the local receiving time.
         The t3 - t1 is the package delay.
         And the (t1+t3)/2 in remote time zone should be of the same time with the t2 in local time zone.
+        The local times are measured by the monotonic time.perf_counter_ns(),
+        and the (t1+t3)/2 is converted into the wall clock after the talks.
         """
-        t1 = time.time()
-        message = f"Echo,{t1}"
-        self.send_message(client_socket, message)
+        t1 = time.perf_counter_ns()
+        message = b'Echo,%d' % t1
+        self.send_message(state, message)
 
-    def receive_echo_response(self, client_socket, echo_data: list):
-        """
-        Handle the received echo response from the client.
-        The [echo_data] is the list storing the echo response,
-        which is appended in-place.
+    def receive_echo_responses(self, state):
         """
-        try:
-            message_length = client_socket.recv(8)
-            if not message_length:
-                return
-            message_length = int.from_bytes(message_length, byteorder='big')
+        Consume the complete frames in the receiving buffer of the client.
+        The other messages, e.g. the Keep-Alive sent right after the identity,
+        are kept in state.pending and handled after the greeting.
 
-            message = b""
-            while len(message) < message_length:
-                chunk = client_socket.recv(
-                    min(message_length - len(message), 1024))
-                if not chunk:
+        Returns:
+            list: The (t1, t2) of the echo responses.
+        """
+        buffer = state.buffer
+        echoes = []
+        consumed = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - consumed >= 8:
+                message_length, = _LENGTH.unpack_from(view, consumed)
+                end = consumed + 8 + message_length
+
+                # Wait for the rest of the message body.
+                if len(buffer) < end:
                     break
-                message += chunk
 
-            if not message:
-                return
+                # Keep the other message in its arriving order.
+                if view[consumed+8:consumed+13] != b'Echo,':
+                    message = bytes(view[consumed+8:end])
+                    consumed = end
+                    assert message, "Empty message is not allowed."
+                    state.pending.append(message)
+                    continue
+
+                # The message is b'Echo,t1,t2', parse the timestamps from the bytes directly.
+                message = bytes(view[consumed+13:end])
+                consumed = end
+                logger.opt(lazy=True).debug(
+                    "Received echo response: {}", lambda: message)
+
+                comma = message.index(b',')
+                echoes.append((float(message[:comma]), float(message[comma+1:])))
 
-            message = message.decode()
-            logger.debug(
-                f"Received message: {message[:20]} ({len(message)} bytes)")
-
-            if message.startswith("Echo"):
-                parts = message.split(',')
-                t1 = float(parts[1])
-                t2 = float(parts[2])
-                t3 = time.time()
-                echo_data.append({'t1': t1, 't2': t2, 't3': t3})
-
-        except (ConnectionResetError, socket.timeout):
-            pass
-        return
-
-    def send_message(self, client_socket, message: str):
-        """Send a message to the client."""
-        message_bytes = message.encode()
-        message_length = len(message_bytes).to_bytes(8, byteorder='big')
-        client_socket.sendall(message_length + message_bytes)
-        logger.debug(f"Sent message: {message[:20]} ({len(message)} bytes)")
-
-    def update_latest_message(self, client_address, message: str, meaningful_message: bool = True):
-        """Update the latest message of the client."""
+        del buffer[:consumed]
+        return echoes
+
+    def send_message(self, state, message):
+        """
+        Send a message to the client, the str message is encoded and the bytes is sent as it is.
+        On the non-blocking socket, the bytes the client can not take at once are buffered,
+        and the selector flushes them when the socket is writable.
+        """
+        message_bytes = message if isinstance(message, bytes) else message.encode()
+        with state.send_lock:
+            if state.socket.getblocking():
+                # Gather the length header and the body in one sendmsg call, without copying the body.
+                sendmsg_all(state.socket, frame_header(len(message_bytes)), message_bytes)
+            else:
+                # Queue the frame behind the buffered bytes to keep the order.
+                state.outbox += frame_header(len(message_bytes))
+                state.outbox += message_bytes
+                self._flush_outbox(state)
+        logger.opt(lazy=True).debug(
+            "Sent message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
+
+    def flush_client(self, state):
+        """
+        Send the buffered frames when the client is writable.
+
+        :return: Whether the client is still open.
+        """
+        try:
+            with state.send_lock:
+                self._flush_outbox(state)
+        except OSError as err:
+            logger.error(f'Occurred: {err}')
+            self.close_client(state)
+            return False
+        return True
+
+    def _flush_outbox(self, state):
+        """Send the buffered bytes as many as the socket takes, the caller holds the send lock."""
+        outbox = state.outbox
+        while outbox:
+            try:
+                sent = state.socket.send(outbox)
+            except BlockingIOError:
+                break
+            del outbox[:sent]
+
+        # Watch the writable event only when there are bytes left.
+        try:
+            key = self.sel.get_key(state.socket)
+        except (KeyError, ValueError):
+            # The client is greeting, it is registered with the events later.
+            return
+        events = self._client_events(state)
+        if key.events != events:
+            self.sel.modify(state.socket, events, state)
+
+    def _client_events(self, state):
+        """The selector events of the client, the writable event is watched when there are bytes to flush."""
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if state.outbox else 0)
+
+    def update_latest_message(self, client_address, message: bytes, meaningful_message: bool = True):
+        """Update the latest message of the client, the GUI shows it in the next refresh."""
         client_info = self.clients.get(client_address)
         if client_info:
             # Only update the latest message when it is the meaningful message.
             if meaningful_message:
-                client_info['latest_message'].set(message)
+                client_info['latest_message'] = message
             # Ascending the messages count.
-            client_info['messages'].set(client_info['messages'].get()+1)
+            client_info['messages'] += 1
+            self.update_client_list_tkUI()
 
     def update_client_list_tkUI(self):
-        """Update the client list in the Tkinter GUI."""
-
-        # Destroy the existing clients.
-        for widget in self.client_list_frame.winfo_children():
-            widget.destroy()
-
-        # Rebuild the client list into the frame (self.client_list_frame).
-        for client_address, client_info in self.clients.items():
-            frame = tk.Frame(self.client_list_frame)
-            # Basic information.
-            tk.Label(frame,
-                     text=f"{client_info['path']} ({client_info['uid']}) {client_address}").pack()
-            # Network information.
-            tk.Label(frame,
-                     text=f"Delay: {client_info['netDelay']:.4f} | Offset: {client_info['netRemoteTime'] - client_info['netLocalTime']:.4f}").pack()
-            # Latest message.
-            tk.Label(frame,
-                     textvariable=client_info['latest_message']).pack()
-            # Messages.
-            tk.Label(frame,
-                     textvariable=client_info['messages']).pack()
-            frame.pack()
-            client_info['frame'] = frame
-            logger.debug(f'Updated UI for client {client_address}')
+        """
+        Request to update the client list in the Tkinter GUI.
+        It is safe to call from any thread,
+        the requests in 50 ms are coalesced into one refresh in the Tkinter thread.
+        """
+        if self.gui is None or self._tkUI_refresh_pending:
+            return
+        self._tkUI_refresh_pending = True
+        self.gui.after(50, self._refresh_client_list_tkUI)
+
+    def _refresh_client_list_tkUI(self):
+        """
+        Refresh the client list in the Tkinter thread.
+        The frame of the client is created once, and destroyed when the client is gone.
+        The labels are updated in place by their variables.
+        """
+        self._tkUI_refresh_pending = False
+        clients = dict(self.clients)
+
+        # Destroy the frames of the disconnected clients.
+        for client_address in [e for e in self.client_frames if e not in clients]:
+            frame, _, _ = self.client_frames.pop(client_address)
+            frame.destroy()
+            logger.debug(f'Removed UI for client {client_address}')
+
+        for client_address, client_info in clients.items():
+            # The client is measuring its connection quality.
+            if client_info['netDelay'] is None:
+                continue
+
+            # Build the frame of the new client into the frame (self.client_list_frame).
+            if client_address not in self.client_frames:
+                frame = tk.Frame(self.client_list_frame)
+                latest_message = tk.StringVar()
+                messages = tk.IntVar()
+                # Basic information.
+                tk.Label(frame,
+                         text=f"{client_info['path']} ({client_info['uid']}) {client_address}").pack()
+                # Network information.
+                tk.Label(frame,
+                         text=f"Delay: {client_info['netDelay']:.4f} | Offset: {client_info['netRemoteTime'] - client_info['netLocalTime']:.4f}").pack()
+                # Latest message.
+                tk.Label(frame,
+                         textvariable=latest_message).pack()
+                # Messages.
+                tk.Label(frame,
+                         textvariable=messages).pack()
+                frame.pack()
+                client_info['frame'] = frame
+                self.client_frames[client_address] = (
+                    frame, latest_message, messages)
+                logger.debug(f'Built UI for client {client_address}')
+
+            _, latest_message, messages = self.client_frames[client_address]
+            # Only the shown message is decoded, once in a refresh.
+            latest_message.set(
+                client_info['latest_message'].decode(errors='replace'))
+            messages.set(client_info['messages'])
 
     def start_gui(self):
         """Start the Tkinter GUI."""
@@ -350,14 +647,18 @@ class ControlCenter:
         self.client_list_frame.pack()
         tk.Button(self.gui, text="Exit", command=self.close_server).pack()
         self.gui.protocol("WM_DELETE_WINDOW", self.close_server)
+        # Show the clients connected before the GUI starts.
+        self.update_client_list_tkUI()
         self.gui.mainloop()
 
     def close_server(self):
         """Close the server and all client connections."""
-        for client_info in tqdm(list(self.clients.values()), 'Closing'):
+        for client_info in list(self.clients.values()):
             client_info['socket'].close()
             logger.info(f'Client {client_info} closed.')
         self.server_socket.close()
+        self.sel.close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
         logger.info('Sever socked closed.')
         self.gui.quit()
         logger.info(f'TK gui quit.')
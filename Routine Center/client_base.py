@@ -1,18 +1,300 @@
+import sys
 import time
-import json
+import orjson
 import socket
-import random
+import struct
+import functools
+import itertools
 import contextlib
 
-from queue import Queue
-from threading import Thread, RLock
+from uuid import uuid4
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+from fastrlock.rlock import FastRLock
+
+# The precompiled 8 bytes big-endian length header of the frame, for packing and unpacking.
+_LENGTH = struct.Struct('>Q')
+
+# The constant prefix of the Keep-Alive message.
+_KEEP_ALIVE = b'Keep-Alive, '
+
+# Ask the kernel to block until the rest of the frame is received, where it is supported.
+# Windows refuses the flag on the non-blocking socket, so it is not used there.
+_RECV_FLAGS = 0 if sys.platform == 'win32' else getattr(socket, 'MSG_WAITALL', 0)
+
+
+@functools.lru_cache(maxsize=256)
+def frame_header(length: int) -> bytes:
+    '''
+    Make the 8 bytes length header of the frame.
+    The Echo and Keep-Alive frames are of a few lengths, so their headers are cached.
+
+    :param length: The length of the message bytes.
+
+    :return: The header bytes.
+    '''
+    return _LENGTH.pack(length)
+
+
+def dumps_letter_head(letter: dict) -> bytes:
+    '''
+    Dump the [letter] without its _timestamp, leaving the _timestamp field open at the end.
+    The letter is forwarded by appending the translated timestamp and the closing brace,
+    so it is dumped once for all the receivers.
+
+    :param letter: The letter to forward.
+
+    :return: The head bytes of the letter.
+    '''
+    body = orjson.dumps({k: v for k, v in letter.items() if k != '_timestamp'})
+    return body[:-1] + (b',"_timestamp":' if len(body) > 2 else b'"_timestamp":')
+
+
+class RouteIndex(object):
+    '''
+    Index the clients by their path and uid, for routing the letters to their dst.
+    The tuples of the clients are replaced as a whole when they change,
+    so the lookup reads them without the lock.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._by_path_uid = {}
+        self._by_path = {}
+
+    def add(self, path: str, uid: str, client):
+        '''
+        Add the [client] of the [path] and [uid].
+        '''
+        with self._lock:
+            key = (path, uid)
+            self._by_path_uid[key] = self._by_path_uid.get(key, ()) + (client,)
+            self._by_path[path] = self._by_path.get(path, ()) + (client,)
+
+    def remove(self, path: str, uid: str, client):
+        '''
+        Remove the [client] of the [path] and [uid], it is fine if it is not added.
+        '''
+        with self._lock:
+            for table, key in ((self._by_path_uid, (path, uid)), (self._by_path, path)):
+                clients = tuple(e for e in table.get(key, ()) if e is not client)
+                if clients:
+                    table[key] = clients
+                else:
+                    table.pop(key, None)
+
+    def lookup(self, path: str, uid: str) -> tuple:
+        '''
+        Lookup the clients of the [path] and [uid].
+
+        :param path: The path of the dst.
+        :param uid: The uid of the dst, all the clients of the [path] are returned if it is empty.
+
+        :return: The tuple of the clients.
+        '''
+        if uid:
+            return self._by_path_uid.get((path, uid), ())
+        return self._by_path.get(path, ())
+
+
+def tune_socket(sock: socket.socket, buffer_size: int = None):
+    '''
+    Tune the socket for the small framed messages.
+    The Nagle's algorithm is disabled, so the short Echo and Keep-Alive messages are sent immediately.
+
+    :param sock: The socket to tune.
+    :param buffer_size: The size of the receiving and sending buffers in bytes.
+        Defaults to None, keeping the kernel's buffer autotuning.
+
+    :return: The tuned socket.
+    '''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Cap the queued but unsent bytes, so sendall returns in the pace of the link.
+    # It keeps the echo delay measurement from being inflated by the local buffer.
+    # The option is not available on Windows.
+    with contextlib.suppress(AttributeError, OSError):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, 16384)
+    # Acknowledge the received segments at once instead of the delayed ACK.
+    # The kernel may fall back to the delayed ACK later, the option is only available on Linux.
+    with contextlib.suppress(AttributeError, OSError):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    # Let the kernel probe the idle peer, the dead peer is detected in about 60 seconds.
+    # The idle, interval and count tunables are only available on Linux.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    with contextlib.suppress(AttributeError, OSError):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    # Manually set buffers disable the autotuning on some kernels.
+    if buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+    return sock
+
+
+def sendmsg_all(sock: socket.socket, *buffers):
+    '''
+    Send the [buffers] as one frame, the buffers are gathered by the kernel with one sendmsg call.
+    The buffers are not concatenated in user space.
+    It falls back to the single sendall of the joined buffers where the sendmsg is not available (Windows).
+
+    :param sock: The socket to send with.
+    :param buffers: The bytes-like objects to send in order.
+    '''
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+
+    views = [memoryview(e) for e in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop the sent buffers, and slice the partly sent one.
+        while views and sent >= views[0].nbytes:
+            sent -= views.pop(0).nbytes
+        if sent:
+            views[0] = views[0][sent:]
+
+
+class FrameReader(object):
+    '''
+    Read the length-prefixed frames from the socket.
+    The bytes are received in large chunks into the buffer,
+    so a single recv_into call usually delivers several small frames,
+    and they are parsed from the buffer without further syscalls.
+    The read_* methods block until the data is ready,
+    and the receive_frames is used when the selector reports the socket is readable.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffer = bytearray(self.chunk_size)
+        # The buffer[start:end] is received but not consumed.
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, size: int):
+        '''
+        Make sure the buffer holds [size] bytes from the start.
+        Move the pending bytes to the front, or grow the buffer for the large frame.
+        '''
+        if len(self.buffer) - self.start >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) < size:
+            buffer = bytearray(max(len(self.buffer) * 2, size))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _fill(self, size: int, waitall: bool = False) -> bool:
+        '''
+        Receive until at least [size] bytes are buffered.
+
+        :param size: The number of bytes required.
+        :param waitall: Whether to receive exactly the missing bytes with MSG_WAITALL,
+            it is used for the rest of the frame body.
+            The flag only works on the blocking socket without timeout,
+            the socket with timeout is non-blocking internally.
+
+        :return: False if the connection is closed before it is done.
+        '''
+        flags = _RECV_FLAGS if self.sock.gettimeout() is None else 0
+        while self.end - self.start < size:
+            self._make_room(size)
+            with memoryview(self.buffer) as view:
+                if waitall:
+                    n = self.sock.recv_into(
+                        view[self.end:self.start+size], 0, flags)
+                else:
+                    n = self.sock.recv_into(view[self.end:])
+            if not n:
+                return False
+            self.end += n
+        return True
+
+    def read_exactly(self, size: int) -> bytes:
+        '''
+        Read [size] bytes, e.g. the key code.
+
+        :return: The bytes, or None if the connection is closed.
+        '''
+        if not self._fill(size):
+            return None
+        data = bytes(self.buffer[self.start:self.start+size])
+        self.start += size
+        return data
+
+    def read_frame(self) -> bytes:
+        '''
+        Read the body of the next frame.
+
+        :return: The body bytes, or None if the connection is closed.
+        '''
+        if not self._fill(8):
+            return None
+        message_length, = _LENGTH.unpack_from(self.buffer, self.start)
+        if not self._fill(8 + message_length, waitall=True):
+            return None
+        begin = self.start + 8
+        self.start = begin + message_length
+        with memoryview(self.buffer) as view:
+            message = bytes(view[begin:self.start])
+        # Rewind the empty buffer, so the next chunk is received from the front.
+        if self.start == self.end:
+            self.start = self.end = 0
+        return message
+
+    def pop_frames(self) -> list:
+        '''
+        Pop the complete frames already in the buffer, without receiving.
+
+        :return: The list of the body bytes.
+        '''
+        frames = []
+        with memoryview(self.buffer) as view:
+            while self.end - self.start >= 8:
+                message_length, = _LENGTH.unpack_from(view, self.start)
+                begin = self.start + 8
+                # Wait for the rest of the frame body.
+                if self.end - begin < message_length:
+                    break
+                self.start = begin + message_length
+                frames.append(bytes(view[begin:self.start]))
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
+
+    def receive_frames(self) -> list:
+        '''
+        Receive once and pop the complete frames, it does not block when the socket is readable.
+        The incomplete frame is kept in the buffer until the rest bytes arrive.
+
+        :return: The list of the body bytes, or None if the connection is closed.
+        '''
+        # Make room for the whole incomplete frame, or a chunk.
+        size = self.chunk_size
+        if self.end - self.start >= 8:
+            message_length, = _LENGTH.unpack_from(self.buffer, self.start)
+            size = max(size, 8 + message_length)
+        self._make_room(size)
+        with memoryview(self.buffer) as view:
+            n = self.sock.recv_into(view[self.end:])
+        if not n:
+            return None
+        self.end += n
+        return self.pop_frames()
 
 
 class MyBag(dict):
-    _rlock = RLock()
+    _rlock = None
 
     def __init__(self):
         super().__init__()
+        # Every bag owns its lock, so the bags do not block each other.
+        self._rlock = FastRLock()
 
     @contextlib.contextmanager
     def freeze_bag(self):
@@ -23,32 +305,46 @@ class MyBag(dict):
         finally:
             self._rlock.release()
 
-    def dumps(self):
-        with self.freeze_bag():
-            return json.dumps(self)
+    def dumps(self) -> bytes:
+        # The bag is copied at once before being dumped,
+        # the lock keeps the copy apart from the list promotion of the repeated uid.
+        with self._rlock:
+            snapshot = dict(self)
+        return orjson.dumps(snapshot)
 
-    def insert_letter(self, letter):
+    def insert_letter(self, letter, copy: bool = True):
         '''
         Insert a letter into the bag.
         Automatically generate the list for repeated uid.
 
         :param letter: The letter to insert.
+        :param copy: Whether to insert the copy of the letter, defaults to True.
+            Use False when the caller hands the letter over and does not change it afterwards,
+            e.g. the letter just made or fetched from another bag.
         '''
         # Make sure the letter is unchanged.
-        letter = letter.copy()
-        with self.freeze_bag():
-            uid = letter.get('uid')
-            # Already have the letter of uid.
-            if uid in self:
-                # Already the list, append.
-                if isinstance(self[uid], list):
-                    self[uid].append(letter)
-                # Not the list, create the list and append the two.
-                if isinstance(self[uid], dict):
-                    self[uid] = [self[uid], letter]
-            # Not have the letter uid.
+        if copy:
+            letter = letter.copy()
+        uid = letter.get('uid')
+
+        # Not have the letter uid.
+        # The setdefault is atomic under the GIL, so the new uid is inserted without the lock.
+        if self.setdefault(uid, letter) is letter:
+            return
+
+        # Already have the letter of uid, it is the rare case.
+        # The setdefault is run again, since the uid may have been fetched and inserted meanwhile.
+        with self._rlock:
+            existing = self.setdefault(uid, letter)
+            # The letter has been fetched meanwhile, the letter is inserted as the new uid.
+            if existing is letter:
+                return
+            # Already the list, append.
+            if isinstance(existing, list):
+                existing.append(letter)
+            # Not the list, create the list and append the two.
             else:
-                self.update({uid: letter})
+                self[uid] = [existing, letter]
 
     def fetch_letter(self, uid):
         '''
@@ -58,10 +354,8 @@ class MyBag(dict):
 
         :return: The letter if exists, otherwise None.
         '''
-        with self.freeze_bag():
-            if uid in self:
-                letter = self.pop(uid)
-                return letter
+        # The pop is atomic under the GIL.
+        return self.pop(uid, None)
 
 
 class MailMan:
@@ -87,16 +381,18 @@ class MailMan:
 
     # Initialize mailman with the session name.
     # The name is unique.
-    session_name = f'{time.time()}-{random.random()}'
+    session_name = uuid4().hex
 
     # Initialize letter index as 0, it naturally grows to idx every letters.
-    letter_idx = 0
+    # The next() of the counter is atomic under the GIL, so the uids are unique across threads.
+    letter_idx = itertools.count()
 
     def __init__(self, session_name: str = None):
         if session_name is None:
-            self.session_name = f'{time.time()}-{random.random()}'
+            self.session_name = uuid4().hex
         else:
             self.session_name = session_name
+        self.letter_idx = itertools.count()
 
     def mk_letter(self, src: str, dst: str, content: str, timestamp: float = None):
         '''
@@ -111,8 +407,7 @@ class MailMan:
             timestamp = time.time()
 
         # Make the uid for the letter
-        uid = f'{self.session_name}-{self.letter_idx}'
-        self.letter_idx += 1
+        uid = f'{self.session_name}-{next(self.letter_idx)}'
         # The letter body
         letter = dict(
             # -- Required --
@@ -128,7 +423,8 @@ class MailMan:
             _stations=[('origin', time.time())],
             # Translate into local times by the control center.
             _timestamp=timestamp)
-        self.bag_history.insert_letter(letter)
+        # The letter is just made, the history keeps it without copying.
+        self.bag_history.insert_letter(letter, copy=False)
         return letter
 
     def pass_letter(self, letter: dict, path_uid: str):
@@ -154,39 +450,55 @@ class MailMan_Deprecated(object):
     bag_pending = {}
 
     # Initialize mailman with the session name.
-    session_name = f'{time.time()}'
+    session_name = uuid4().hex
 
     # Initialize letter index as 0, it naturally grows to idx every letters.
-    letter_idx = 0
+    # The next() of the counter is atomic under the GIL, so the uids are unique across threads.
+    letter_idx = itertools.count()
 
-    # Lock for the bag operation.
-    bag_lock = RLock()
+    # Locks for the bag operations, every bag owns its lock.
+    # The bag_lock is kept for the callers locking all the bags.
+    bag_lock = FastRLock()
+    _lock_await = FastRLock()
+    _lock_finished = FastRLock()
+    _lock_expired = FastRLock()
+    _lock_pending = FastRLock()
 
     def __init__(self, session_name: str = None):
         if session_name:
             self.session_name = session_name
-        self.ui_update_needed = False
+        self.letter_idx = itertools.count()
+        # The dirty bit of every bag, the UI only refreshes the changed bags.
+        self._dirty = dict.fromkeys(
+            ('await', 'finished', 'expired', 'pending'), False)
         self.init_ui()
 
+    @property
+    def ui_update_needed(self) -> bool:
+        '''Whether any bag is changed.'''
+        return any(self._dirty.values())
+
+    @ui_update_needed.setter
+    def ui_update_needed(self, value: bool):
+        for key in self._dirty:
+            self._dirty[key] = value
+
     @contextlib.contextmanager
     def lock_bag(self):
-        '''Lock the bag for operations.'''
-        self.bag_lock.acquire()
-        try:
+        '''Lock all the bags for operations.'''
+        with self.bag_lock, self._lock_await, self._lock_finished, self._lock_expired, self._lock_pending:
             yield
-        finally:
-            self.bag_lock.release()
 
     def insert_pending_letter(self, letter):
-        with self.lock_bag():
+        with self._lock_pending:
             self.bag_pending[letter['uid']] = letter
-            self.ui_update_needed = True
+            self._dirty['pending'] = True
 
     def remove_pending_letter(self, uid):
-        with self.lock_bag():
+        with self._lock_pending:
             if uid in self.bag_pending:
                 letter = self.bag_pending.pop(uid)
-                self.ui_update_needed = True
+                self._dirty['pending'] = True
                 return letter
 
     def retrieve_letter_in_waiting(self, uid):
@@ -196,10 +508,10 @@ class MailMan_Deprecated(object):
         Args:
             uid (str): The unique identifier for the letter.
         '''
-        with self.lock_bag():
+        with self._lock_await:
             if uid in self.bag_await_response:
                 letter = self.bag_await_response.pop(uid)
-                self.ui_update_needed = True
+                self._dirty['await'] = True
                 return letter
             else:
                 return None
@@ -211,9 +523,9 @@ class MailMan_Deprecated(object):
         Args:
             letter (dict): A dictionary for the letter.
         '''
-        with self.lock_bag():
+        with self._lock_await:
             self.bag_await_response[letter['uid']] = letter
-            self.ui_update_needed = True
+            self._dirty['await'] = True
 
     def archive_finished_letter(self, letter):
         '''
@@ -222,9 +534,9 @@ class MailMan_Deprecated(object):
         Args:
             letter (dict): A dictionary for the letter.
         '''
-        with self.lock_bag():
+        with self._lock_finished:
             self.bag_finished[letter['uid']] = letter
-            self.ui_update_needed = True
+            self._dirty['finished'] = True
 
     def mark_expired_letter_with_uid(self, uid):
         '''
@@ -235,9 +547,9 @@ class MailMan_Deprecated(object):
         '''
         letter = self.retrieve_letter_in_waiting(uid)
         if letter:
-            with self.lock_bag():
+            with self._lock_expired:
                 self.bag_expired[uid] = letter
-                self.ui_update_needed = True
+                self._dirty['expired'] = True
             return letter
         else:
             return None
@@ -247,8 +559,7 @@ class MailMan_Deprecated(object):
             timestamp = time.time()
 
         # Make the uid for the letter
-        uid = f'{self.session_name}-{self.letter_idx}-{timestamp}'
-        self.letter_idx += 1
+        uid = f'{self.session_name}-{next(self.letter_idx)}-{timestamp}'
         # The letter body
         letter = dict(
             # -- Required --
@@ -293,6 +604,11 @@ class BaseClientSocket:
     host = 'localhost'
     port = 12345
     timeout = 1000
+    # The socket buffer size in bytes, e.g. 4 * 1024 * 1024.
+    # None keeps the kernel's autotuning.
+    socket_buffer_size = None
+    # The max number of the frames waiting to be sent.
+    send_queue_size = 1024
 
     # Good to go stuff
     good_to_go_queue = Queue(10)
@@ -312,6 +628,13 @@ class BaseClientSocket:
         # Establish the socket connection.
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.settimeout(self.timeout)
+        tune_socket(self.client_socket, self.socket_buffer_size)
+        # The buffered reader of the receiving frames.
+        self._reader = FrameReader(self.client_socket)
+        # The outgoing frames, they are sent by the keep_sending thread.
+        self._send_queue = Queue(self.send_queue_size)
+        self._send_thread = None
+        self._send_error = None
 
     def keep_alive(self, interval: float = 5):
         '''
@@ -323,7 +646,8 @@ class BaseClientSocket:
         def _keep_alive():
             while True:
                 try:
-                    self.send_message(f'Keep-Alive, {time.time()}')
+                    self.send_message(
+                        _KEEP_ALIVE + repr(time.time()).encode())
                     time.sleep(interval)
                 except (ConnectionAbortedError, ConnectionResetError, socket.timeout):
                     break
@@ -346,6 +670,35 @@ class BaseClientSocket:
                     raise err
         Thread(target=_receive_message, daemon=True).start()
 
+    def keep_sending(self, batch_size: int = 64):
+        '''
+        Keep sending the queued frames.
+        The frames queued in the meantime are gathered and sent with one syscall.
+
+        Args:
+            - batch_size (int), the max number of frames sent at once, defaults to 64.
+        '''
+        def _send_frames():
+            while True:
+                frames = [self._send_queue.get()]
+                with contextlib.suppress(Empty):
+                    while len(frames) < batch_size:
+                        frames.append(self._send_queue.get_nowait())
+                # The None is the stop signal, the frames before it are sent anyway.
+                stop = None in frames
+                buffers = [e for frame in frames if frame for e in frame]
+                try:
+                    sendmsg_all(self.client_socket, *buffers)
+                except OSError as err:
+                    # Raise the error for the later send_message calls.
+                    self._send_error = err
+                    print(f'Connection is broken : {err}')
+                    break
+                if stop:
+                    break
+        self._send_thread = Thread(target=_send_frames, daemon=True)
+        self._send_thread.start()
+
     def send_initial_info(self):
         '''Send initial info, tell the server who am I.'''
         initial_message = f"{self.path},{self.uid}"
@@ -355,21 +708,28 @@ class BaseClientSocket:
     def send_message(self, message, include_key=False):
         '''
         Send the [message] to the server.
+        It is queued and sent by the keep_sending thread, so the frames from the threads do not interleave.
         The wrapped message format is 
-            - If include_key, "8 bytes length" + "message bytes".
-            - Else, "key bytes" + "8 bytes length" + "message bytes".
+            - If include_key, "key bytes" + "8 bytes length" + "message bytes".
+            - Else, "8 bytes length" + "message bytes".
 
         Args:
-            message (str): The message to send.
+            message (str | bytes): The message to send, the bytes is sent as it is.
             include_key (bool): Whether to include the authorization key, defaults to False.
         '''
-        message_bytes = message.encode()
-        message_length = len(message_bytes).to_bytes(8, byteorder='big')
+        if self._send_error:
+            raise self._send_error
+        # The frames queued before connect() would go out ahead of the keyed identity frame.
+        if self._send_thread is None:
+            raise ConnectionError('The client is not connected, call connect() first.')
+        message_bytes = message if isinstance(message, bytes) else message.encode()
+        # The parts of the frame are queued without copying the message bytes,
+        # and they are gathered with the other queued frames by the keep_sending thread.
+        header = frame_header(len(message_bytes))
         if include_key:
-            self.client_socket.sendall(
-                self.key_code + message_length + message_bytes)
+            self._send_queue.put((self.key_code, header, message_bytes))
         else:
-            self.client_socket.sendall(message_length + message_bytes)
+            self._send_queue.put((header, message_bytes))
         # print(f"Sent message: {message}")
         return message
 
@@ -377,6 +737,7 @@ class BaseClientSocket:
         '''Connect to the self.host:self.port.'''
         self.client_socket.connect((self.host, self.port))
         print(f"Connecting to server at {self.host}:{self.port}")
+        self.keep_sending()
         self.send_initial_info()
         self.keep_receiving()
         self.keep_alive()
@@ -386,62 +747,56 @@ class BaseClientSocket:
 
     def close(self):
         '''Close the socket.'''
+        # Send the queued frames before closing.
+        # The queue is full if the server stops reading, the socket is closed anyway,
+        # and closing it also breaks the blocking send of the sending thread.
+        if self._send_thread:
+            with contextlib.suppress(Full):
+                self._send_queue.put(None, timeout=1)
+            self._send_thread.join(timeout=1)
         self.client_socket.close()
         print("Connection closed")
 
     def receive_message(self):
-        # Read the length of the incoming message (8 bytes for larger messages).
-        message_length = self.client_socket.recv(8)
-        if not message_length:
-            return None
-        message_length = int.from_bytes(message_length, byteorder='big')
-
-        # Read the actual message based on the length.
-        message = b""
-        while len(message) < message_length:
-            chunk = self.client_socket.recv(
-                min(message_length - len(message), 1024))
-            if not chunk:
-                break
-            message += chunk
-
-        # Return None if the message is empty.
+        # Read the next frame from the buffered reader.
+        # The reader is only used by the receiving thread.
+        message = self._reader.read_frame()
+
+        # Return None if the message is empty or broken.
         if not message:
             return None
 
-        # Decode the message into str format.
-        message = message.decode()
+        # The message is dispatched in bytes, it is decoded only when it is handed to the handle_message.
         self.handle_incoming_message(message)
         return message
 
-    def handle_incoming_message(self, message: str):
+    def handle_incoming_message(self, message: bytes):
         '''
         Handle the receiving [message].
         '''
         # Handle the inner packages.
-        if message.startswith("Echo"):
+        if message.startswith(b"Echo"):
             # Handle the epoch package.
-            parts = message.split(',')
-            t1 = float(parts[1])
+            # The message is b'Echo,t1', the t1 is echoed back as it is received.
             t2 = time.time()
-            response_message = f"Echo,{t1},{t2}"
-            self.send_message(response_message)
+            self.send_message(message + b',' + repr(t2).encode())
 
         # Handle acquire bag messages.
-        elif message.startswith('AcquireBags'):
+        elif message.startswith(b'AcquireBags'):
             for name, bag in self.mm.bags.items():
+                name = name.encode()
                 if name in message:
                     # print(f'Acquired bag: {name}')
-                    self.send_message(name + ':' + bag.dumps())
+                    self.send_message(name + b':' + bag.dumps())
 
         # Handle good to go message.
         # Release the blocking status.
-        elif message.startswith('YouAreGoodToGo'):
-            self.good_to_go_queue.put_nowait(message)
+        elif message.startswith(b'YouAreGoodToGo'):
+            self.good_to_go_queue.put_nowait(message.decode())
 
         # Handle other messages.
         else:
-            self.handle_message(message)
+            self.handle_message(message.decode())
         return
 
     def handle_message(self, message: str):
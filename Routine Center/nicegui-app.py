@@ -1,24 +1,21 @@
 # %%
 import time
-import json
+import orjson
 import socket
+import selectors
 import contextlib
-import pandas as pd
+import numpy as np
 
 from enum import Enum
 from nicegui import ui
-from threading import Thread
-from collections import defaultdict
-
-import queue
-from queue import Queue
+from threading import Thread, Event, Lock
+from collections import defaultdict, deque
 
 from loguru import logger
-from tqdm.auto import tqdm
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from urllib.parse import urlparse
 
-from client_base import MailMan
+from client_base import MailMan, FrameReader, RouteIndex, dumps_letter_head, frame_header, sendmsg_all, tune_socket
 
 logger.add('log/BCI station control center.log', rotation='5 MB')
 
@@ -26,6 +23,12 @@ logger.add('log/BCI station control center.log', rotation='5 MB')
 
 mm = MailMan()
 
+# The wire frames requesting the bags of the client, they are sent at every Keep-Alive.
+# They are made once and sent with a single sendall.
+_ACQUIRE_BAGS_FRAMES = b''.join(
+    frame_header(len(body)) + body
+    for body in (f'AcquireBags-{key}'.encode() for key in mm.bags))
+
 
 class ClientStatus(Enum):
     Initialized = 'Initialized, but not used.'
@@ -34,31 +37,48 @@ class ClientStatus(Enum):
     Disconnected = 'Has been disconnected.'
 
 
-@dataclass(slots=False)
+class NotifiableDeque(deque):
+    '''
+    The deque notifying the consumer when the element is appended.
+    The append and popleft are atomic under the GIL, only the waking uses the event.
+    '''
+
+    def __init__(self, maxlen: int = None):
+        super().__init__(maxlen=maxlen)
+        self.event = Event()
+
+    def append(self, x):
+        super().append(x)
+        self.event.set()
+
+
+@dataclass(slots=True)
 class IncomingClient:
+    # The slots save the per-instance dict, every attribute must be declared as the field.
     # Basic information
     address: str = 'Client address'
     path: str = 'Path of the client'
     uid: str = 'UID of the client'
     # Connection and its quality
-    socket = None
+    socket: 'socket.socket' = None
+    # The buffered frame reader of the socket.
+    reader: FrameReader = None
+    # The lock serializing the frames sent by the threads, so they do not interleave.
+    send_lock: Lock = field(default_factory=Lock)
     netDelay: float = 0
     netRemoteTime: float = 0
     netLocalTime: float = 0
     # Status of the client
-    status: ClientStatus = None  # ClientStatus.Initialized
-    # Message queue
-    message_queue: Queue = None  # Queue(1000)
-    # Echo data
-    echo_data: list = None  # []
+    status: ClientStatus = ClientStatus.Initialized
+    # Message queue, the oldest message is dropped when it is full.
+    message_queue: NotifiableDeque = field(
+        default_factory=lambda: NotifiableDeque(maxlen=1000))
+    # Echo data, the element is (t1, t2, t3)
+    echo_data: list = field(default_factory=list)
+    # The messages arrived among the echo responses, they are handled after the greeting.
+    pending: list = field(default_factory=list)
     # Bags
-    bags: dict = None  # {k: None for k in mm.bags}
-
-    def __init__(self):
-        self.bags = {k: None for k in mm.bags}
-        self.message_queue = Queue(1000)
-        self.status = ClientStatus.Initialized
-        self.echo_data = []
+    bags: dict = field(default_factory=lambda: {k: None for k in mm.bags})
 
     def update(self, **kwargs):
         '''
@@ -84,23 +104,21 @@ class IncomingClient:
 
         The connection quality attributes of netDelay, netRemoteTime and netLocalTime are updated according to the table.
 
-        :return: Connection quality table.
+        :return: Connection quality table, the columns are t1, t2, t3 and delay.
         '''
-        df = pd.DataFrame(self.echo_data)
-        df['delay'] = df['t3'] - df['t1']
-        df['tServer'] = (df['t3'] + df['t1']) / 2
-        df['tClient'] = df['t2']
-        df = df.sort_values(by='delay', ascending=True)
+        table = np.array(self.echo_data, dtype=np.float64).reshape(-1, 3)
+        t1, t2, t3 = table.T
+        delay = t3 - t1
 
         # Update the connection quality attributes by the lowest delay record.
+        i = int(delay.argmin())
         connection_quality = dict(
-            netDelay=float(df.iloc[0]['delay']),
-            netRemoteTime=float(df.iloc[0]['tClient']) +
-            float(df.iloc[0]['delay'])/2,
-            netLocalTime=float(df.iloc[0]['tServer'])
+            netDelay=float(delay[i]),
+            netRemoteTime=float(t2[i] + delay[i] / 2),
+            netLocalTime=float((t3[i] + t1[i]) / 2)
         )
         self.update(**connection_quality)
-        return df
+        return np.column_stack((table, delay))
 
 
 class ControlCenter:
@@ -114,6 +132,11 @@ class ControlCenter:
     host = 'localhost'
     port = 12345
     valid_key = b'12345678'
+    # The socket buffer size in bytes, e.g. 4 * 1024 * 1024.
+    # None keeps the kernel's autotuning.
+    socket_buffer_size = None
+    # The seconds waiting for the next echo response.
+    echo_timeout = 0.5
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     incoming_clients = {}
 
@@ -124,57 +147,98 @@ class ControlCenter:
             self.port = port
         if valid_key:
             self.valid_key = valid_key
+        # The connected clients are served by the selector in a single thread.
+        self.sel = selectors.DefaultSelector()
+        # The connected clients indexed by their path and uid, for routing the letters.
+        self.routes = RouteIndex()
+        # The received letters waiting for the dispatcher, the element is (message, ic).
+        # The event wakes the dispatcher when the letters are appended.
+        self._letters = deque()
+        self._letters_ready = Event()
+        # The bag names in bytes, the bag message is b'name:content'.
+        self._bag_names = {name.encode(): name for name in mm.bags}
+        # The message handlers by the verb of the message.
+        self._handlers = {
+            b'Echo': self._on_echo,
+            b'Keep-Alive': self._on_keep_alive,
+        }
         logger.info(f"Initialized control center {self}")
 
     def start_server(self):
         """Start the server and begin accepting clients."""
+        tune_socket(self.server_socket, self.socket_buffer_size)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
         logger.info(f"Server started on {self.host}:{self.port}")
         Thread(target=self.accept_clients, daemon=True).start()
+        Thread(target=self.serve_clients, daemon=True).start()
+        Thread(target=self.dispatch_letters, daemon=True).start()
 
     def accept_clients(self):
         """Accept incoming client connections."""
         while True:
             client_socket, client_address = self.server_socket.accept()
+            tune_socket(client_socket, self.socket_buffer_size)
             logger.info(f"Client {client_address} connected")
             Thread(target=self.handle_client, args=(
-                client_socket, client_address)).start()
+                client_socket, client_address), daemon=True).start()
+
+    def serve_clients(self):
+        """Receive the messages of the connected clients with the selector in a single thread."""
+        while True:
+            # The timeout makes sure the sockets registered by other threads are selected in time.
+            for key, _ in self.sel.select(timeout=1):
+                ic: IncomingClient = key.data
+                try:
+                    frames = ic.reader.receive_frames()
+                    # The client is gone.
+                    if frames is None:
+                        self.close_client(ic)
+                        continue
+                    self._handle_client_messages(ic, frames)
+                # The failure of one client must not stop the selector serving the others.
+                except Exception as err:
+                    logger.error(f'Occurred: {err}')
+                    self.close_client(ic)
+
+    def close_client(self, ic: IncomingClient):
+        """Stop serving the client and close its socket."""
+        with contextlib.suppress(KeyError, ValueError):
+            self.sel.unregister(ic.socket)
+        ic.socket.close()
+        ic.status = ClientStatus.Disconnected
+        self.routes.remove(ic.path, ic.uid, ic)
 
     def handle_client(self, client_socket, client_address):
-        """Handle communication with a connected client."""
+        """
+        Handle the connecting client.
+        The key, the identity and the echo packages are exchanged in this thread,
+        and the connected client is handed over to the selector.
+        """
         # Receive the hello message from the client.
         # Read the advanced key code (8 bytes) for identifying the legal client.
         try:
-            key_code = client_socket.recv(8)
+            # The frames are read through the buffered reader from now on.
+            reader = FrameReader(client_socket)
+            key_code = reader.read_exactly(8)
             if key_code != self.valid_key:
                 logger.warning(
                     f"Client {client_address} provided invalid key. Disconnecting.")
                 client_socket.close()
                 return
 
-            # Read the length of the initial message (8 bytes for larger messages)
-            message_length = client_socket.recv(8)
-            if not message_length:
+            # Read the initial message.
+            message = reader.read_frame()
+            if message is None:
                 return
-            message_length = int.from_bytes(message_length, byteorder='big')
-
-            # Read the actual message based on the length
-            message = b""
-            while len(message) < message_length:
-                chunk = client_socket.recv(
-                    min(message_length - len(message), 1024))
-                if not chunk:
-                    return
-                message += chunk
 
             # Not allow the empty message body.
             assert message, "Empty message is not allowed."
 
             # The message body contains the identity.
             message = message.decode()
-            logger.debug(
-                f"Received message: {message[:20]} ({len(message)} bytes)")
+            logger.opt(lazy=True).debug(
+                "Received message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
             client_info = message.split(',')
             client_path = client_info[0]
             client_uid = client_info[1]
@@ -185,6 +249,7 @@ class ControlCenter:
                 # Basic information of the socket.
                 'address': client_address,
                 'socket': client_socket,
+                'reader': reader,
                 'path': client_path,
                 'uid': client_uid,
             })
@@ -197,6 +262,7 @@ class ControlCenter:
             ic.status = ClientStatus.Connected
 
             self.incoming_clients[client_address] = ic
+            self.routes.add(ic.path, ic.uid, ic)
             logger.info(f'Client comes: {ic}')
         except Exception as err:
             logger.error('Error occurred during connecting.')
@@ -204,142 +270,164 @@ class ControlCenter:
 
         # Now I have the legal IncomingClient.
         try:
-            self.send_message(ic.socket, 'YouAreGoodToGo')
-            self._handle_client_message_loop(ic)
-        except (ConnectionResetError, ConnectionAbortedError, AssertionError) as err:
+            self.send_message(ic, 'YouAreGoodToGo')
+            # Handle the frames arrived among and after the echo responses in order,
+            # and keep listening for the messages from the client in the selector.
+            pending, ic.pending = ic.pending, []
+            self._handle_client_messages(ic, pending)
+            self._handle_client_messages(ic, ic.reader.pop_frames())
+            self.sel.register(ic.socket, selectors.EVENT_READ, ic)
+        except Exception as err:
             logger.error(f'Occurred: {err}')
-        finally:
-            client_socket.close()
-            ic.status = ClientStatus.Disconnected
+            self.close_client(ic)
         return
 
-    def _handle_client_message_loop(self, ic: IncomingClient):
-        # Keep listening for the messages from the client.
-        while True:
-            # Receive the header
-            # The header is message length
-            message_length = ic.socket.recv(8)
-            # Break out if message_length is null
-            if not message_length:
-                break
-            message_length = int.from_bytes(
-                message_length, byteorder='big')
-
-            # Receive the message body on message_length.
-            message = b""
-            while len(message) < message_length:
-                chunk = ic.socket.recv(
-                    min(message_length - len(message), 1024))
-                if not chunk:
-                    break
-                message += chunk
-
+    def _handle_client_messages(self, ic: IncomingClient, frames: list):
+        for message in frames:
             # Not allow the empty message body.
             assert message, "Empty message is not allowed."
 
-            message = message.decode()
-            logger.debug(
-                f"Received message: {message[:20]} ({len(message)} bytes)")
+            # The message is dispatched in bytes.
+            logger.opt(lazy=True).debug(
+                "Received message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
 
-            self.handle_message(message, ic)
+            # The letters are forwarded by the dispatcher,
+            # so the slow fan-out does not stop receiving from the clients.
+            # The inner packages are handled at once, keeping the echo time accurate.
+            if message.startswith(b'{'):
+                self._letters.append((message, ic))
+                self._letters_ready.set()
+            else:
+                self.handle_message(message, ic)
 
-            try:
-                ic.message_queue.put_nowait(message)
-            except queue.Full:
-                logger.warning('Message queue is full.')
+            # The append is atomic under the GIL, no lock is needed.
+            ic.message_queue.append(message)
 
-            # The next while loop.
-            continue
-
-    def handle_message(self, message: str, sic: IncomingClient):
-        # TODO: Handle the message from the client
+    def dispatch_letters(self):
+        """Forward the received letters in their arriving order, in a single thread."""
+        while True:
+            self._letters_ready.wait()
+            # Clear before draining, so the letter appended meanwhile sets the event again.
+            self._letters_ready.clear()
+            while self._letters:
+                message, ic = self._letters.popleft()
+                try:
+                    self.handle_message(message, ic)
+                except Exception as err:
+                    logger.error(f'Occurred: {err}')
+
+    def handle_message(self, message: bytes, sic: IncomingClient):
+        """
+        Dispatch the [message] to its handler.
+        The bag message is looked up by the name before the first colon,
+        the other messages by the verb before the first comma, or by the leading '{' of the json letter.
+        """
         # Handle the bags message.
         # It aligns with the MailMan's bag.
-        for bag_name in sic.bags.keys():
-            if message.startswith(bag_name):
-                content = message
-                # content = message.split(':', 1)[1]
-                # content = json.loads(content)
-                sic.bags.update(
-                    {bag_name: f'{sic.address}-{sic.path}-{sic.uid}'+content})
-                return message
-
-        # Handle echo package.
-        if message.startswith("Echo"):
-            # Handle the echo package AFTER the connection has been established.
-            # It is used to sync the client during the workflow.
-            parts = message.split(',')
-            t1 = float(parts[1])
-            t2 = float(parts[2])
-            t3 = time.time()
-            sic.echo_data.append({'t1': t1, 't2': t2, 't3': t3})
-            logger.debug('Received echo message.')
-
-        # Handle keep-alive package.
-        elif message.startswith("Keep-Alive"):
-            # Request bag information.
-            for key in mm.bags.keys():
-                self.send_message(sic.socket, f'AcquireBags-{key}')
-            # Not doing anything.
-            pass
-
-        # Handle other json package.
-        elif message.startswith("{"):
-            # The incoming message is the json object
-            raw_letter = json.loads(message)
-
-            url = urlparse(raw_letter['dst'])
-            path = url.path
-            uid = url.query
-
-            raw_letter['_stations'].append(('ControlCenter', time.time()))
-
-            # Transfer it to the client with dst path
-            count = 0
-            for _, v in self.incoming_clients.items():
-                dic: IncomingClient = v
-                if dic.status is not ClientStatus.Connected:
-                    continue
-                # Check if the dst_client matches with the letter's dst.
-                if dic.path == path and any((dic.uid == uid, len(uid) == 0)):
-                    # Make the new letter.
-                    letter = raw_letter.copy()
-                    # Translate the timestamp into dst's timestamp.
-                    t = letter['_timestamp']
-                    # Translate src time into local time
-                    t = t - sic.netRemoteTime + sic.netLocalTime
-                    # Translate local time into dst time
-                    t = t - dic.netLocalTime + dic.netRemoteTime
-                    letter['_timestamp'] = t
-                    self.send_message(dic.socket, json.dumps(letter))
-                    logger.info(f'Translated {letter} to {dic.address}')
-                    count += 1
-
-            # If the letter is not delivered, log the warning.
-            if count == 0:
-                logger.warning(f'Received {raw_letter}, but did not deliver.')
+        if bag_name := self._bag_names.get(message.partition(b':')[0]):
+            # Only the bag content is decoded, since it is shown in the textarea.
+            content = message.decode()
+            sic.bags.update(
+                {bag_name: f'{sic.address}-{sic.path}-{sic.uid}'+content})
+            return message
+
+        if handler := self._handlers.get(message.partition(b',')[0]):
+            handler(message, sic)
+        elif message.startswith(b"{"):
+            self._on_letter(message, sic)
         else:
-            logger.error(f'Can not handle message: {message}')
+            logger.error(f'Can not handle message: {message.decode(errors="replace")}')
 
         # Update the latest message.
         self.update_latest_message(sic, message)
 
         return message
 
+    def _on_echo(self, message: bytes, sic: IncomingClient):
+        """
+        Handle the echo package AFTER the connection has been established.
+        It is used to sync the client during the workflow.
+        The message is b'Echo,t1,t2'.
+        """
+        comma = message.index(b',', 5)
+        t1 = float(message[5:comma])
+        t2 = float(message[comma+1:])
+        t3 = time.time()
+        sic.echo_data.append((t1, t2, t3))
+        logger.debug('Received echo message.')
+
+    def _on_keep_alive(self, message: bytes, sic: IncomingClient):
+        """Handle keep-alive package, request bag information."""
+        with sic.send_lock:
+            sic.socket.sendall(_ACQUIRE_BAGS_FRAMES)
+
+    def _on_letter(self, message: bytes, sic: IncomingClient):
+        """Handle the json letter, transfer it to the clients with the dst path."""
+        # The incoming message is the json object, it is loaded from the bytes directly.
+        raw_letter = orjson.loads(message)
+
+        url = urlparse(raw_letter['dst'])
+        path = url.path
+        uid = url.query
+
+        raw_letter['_stations'].append(('ControlCenter', time.time()))
+
+        # The letter is dumped once, only the translated timestamp differs between the receivers.
+        head = None
+
+        # Transfer it to the client with dst path
+        count = 0
+        # The clients matching with the letter's dst are looked up in the index.
+        for dic in self.routes.lookup(path, uid):
+            if dic.status is not ClientStatus.Connected:
+                continue
+            if head is None:
+                head = dumps_letter_head(raw_letter)
+            # Translate the timestamp into dst's timestamp.
+            t = raw_letter['_timestamp']
+            # Translate src time into local time
+            t = t - sic.netRemoteTime + sic.netLocalTime
+            # Translate local time into dst time
+            t = t - dic.netLocalTime + dic.netRemoteTime
+            letter = head + repr(t).encode() + b'}'
+            self.send_message(dic, letter)
+            logger.info(f'Translated {letter.decode()} to {dic.address}')
+            count += 1
+
+        # If the letter is not delivered, log the warning.
+        if count == 0:
+            logger.warning(f'Received {raw_letter}, but did not deliver.')
+
     def exchange_echo_packages(self, ic: IncomingClient):
         """
         Send and receive a chunk of echo packages.
 
         Attention, this methods duplicates 20 talks to prevent random delay occasionally.
-        There are 10 ms gaps between talks, so it costs about 0.2 seconds to finish.
+        The talks are pipelined, all the packages are sent back-to-back before receiving the responses.
+        Every response carries its own t1, so it costs about one round trip to finish.
         """
-        for _ in tqdm(range(20), 'Echo'):
-            self.send_echo_package(ic.socket)
-            self.receive_echo_response(ic.socket, ic.echo_data)
-            time.sleep(0.01)
+        for _ in range(20):
+            self.send_echo_package(ic)
+
+        # Stop waiting if the client keeps silent for the echo_timeout.
+        ic.socket.settimeout(self.echo_timeout)
+        try:
+            n = 0
+            while n < 20:
+                received = self.receive_echo_response(
+                    ic.reader, ic.echo_data, ic.pending)
+                if received is None:
+                    break
+                n += received
+        finally:
+            ic.socket.settimeout(None)
+
+        if not ic.echo_data:
+            raise TimeoutError('No echo response is received')
+        logger.info(f'Exchanged {n} echo packages with {ic.address}')
         return ic.estimate_connection_quality()
 
-    def send_echo_package(self, client_socket):
+    def send_echo_package(self, ic: IncomingClient):
         """
         Send a single echo package to the client.
         The package is finished in 3 steps:
@@ -350,66 +438,65 @@ class ControlCenter:
         And the (t1+t3)/2 in remote time zone should be of the same time with the t2 in local time zone.
         """
         t1 = time.time()
-        message = f"Echo,{t1}"
-        self.send_message(client_socket, message)
+        message = b'Echo,' + repr(t1).encode()
+        self.send_message(ic, message)
 
-    def receive_echo_response(self, client_socket, echo_data: list):
+    def receive_echo_response(self, reader: FrameReader, echo_data: list, pending: list):
         """
         Handle the received echo response from the client.
         The [echo_data] is the list storing the echo response,
         which is appended in-place.
+        The [pending] is the list keeping the other messages in their arriving order,
+        e.g. the Keep-Alive sent right after the identity.
+
+        :return: Whether the echo response is received, None if the connection is closed or timeout.
         """
         try:
-            message_length = client_socket.recv(8)
-            if not message_length:
-                return
-            message_length = int.from_bytes(message_length, byteorder='big')
-
-            message = b""
-            while len(message) < message_length:
-                chunk = client_socket.recv(
-                    min(message_length - len(message), 1024))
-                if not chunk:
-                    break
-                message += chunk
+            message = reader.read_frame()
 
-            if not message:
-                return
+            if message is None:
+                return None
 
-            message = message.decode()
-            logger.debug(
-                f"Received message: {message[:20]} ({len(message)} bytes)")
+            logger.opt(lazy=True).debug(
+                "Received message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
 
-            if message.startswith("Echo"):
-                parts = message.split(',')
-                t1 = float(parts[1])
-                t2 = float(parts[2])
+            if message.startswith(b"Echo"):
+                comma = message.index(b',', 5)
+                t1 = float(message[5:comma])
+                t2 = float(message[comma+1:])
                 t3 = time.time()
-                echo_data.append({'t1': t1, 't2': t2, 't3': t3})
+                echo_data.append((t1, t2, t3))
+                return True
+
+            pending.append(message)
 
         except (ConnectionResetError, socket.timeout):
-            pass
-        return
+            return None
+        return False
 
-    def send_message(self, client_socket, message: str):
-        """Send a message to the client."""
-        if client_socket is None:
+    def send_message(self, ic: IncomingClient, message):
+        """
+        Send a message to the client, the str message is encoded and the bytes is sent as it is.
+        The header and the message are gathered by one sendmsg call without concatenating.
+        """
+        if ic.socket is None:
             return
-        message_bytes = message.encode()
-        message_length = len(message_bytes).to_bytes(8, byteorder='big')
-        client_socket.sendall(message_length + message_bytes)
-        logger.debug(f"Sent message: {message[:20]} ({len(message)} bytes)")
+        message_bytes = message if isinstance(message, bytes) else message.encode()
+        with ic.send_lock:
+            sendmsg_all(ic.socket, frame_header(len(message_bytes)), message_bytes)
+        logger.opt(lazy=True).debug(
+            "Sent message: {} ({} bytes)", lambda: message[:20], lambda: len(message))
         return
 
-    def update_latest_message(self, ic: IncomingClient, message: str):
+    def update_latest_message(self, ic: IncomingClient, message: bytes):
         """Update the latest message of the client."""
         pass
 
     def close_server(self):
         """Close the server and all client connections."""
-        for client_info in tqdm(list(self.incoming_clients.values()), 'Closing'):
-            client_info['socket'].close()
-            logger.info(f'Client {client_info} closed.')
+        for ic in list(self.incoming_clients.values()):
+            self.close_client(ic)
+            logger.info(f'Client {ic} closed.')
         self.server_socket.close()
         logger.info('Sever socked closed.')
 
@@ -436,21 +523,22 @@ class NiceGuiManager(object):
     cc = control_center
     thread_book = {}
 
-    def log_rolling_thread(self, message_log: ui.log, message_queue: Queue, thread_name: str):
+    def log_rolling_thread(self, message_log: ui.log, message_queue: NotifiableDeque, thread_name: str):
         '''
         Log rolling thread for the message log.
 
         :params message_log (ui.log): the message log widget.
-        :params message_queue (Queue): The queue to get the message.
+        :params message_queue (NotifiableDeque): The queue to get the message.
         :params thread_name (str): The name of the thread.
         '''
         while thread_name in self.thread_book:
-            # Set the timeout to avoid blocking forever.
-            # And handle the empty exception in case of empty queue situation.
-            try:
-                message_log.push(message_queue.get(timeout=1))
-            except queue.Empty:
-                continue
+            # Set the timeout to check the thread_book in time.
+            # Clear before draining, so the message appended meanwhile sets the event again.
+            message_queue.event.wait(timeout=1)
+            message_queue.event.clear()
+            # The messages are queued in bytes, they are decoded in the log thread.
+            while message_queue:
+                message_log.push(message_queue.popleft().decode(errors='replace'))
         message_log.push('Log rolling thread stopped.')
 
     def timer_callback(self):
@@ -460,7 +548,9 @@ class NiceGuiManager(object):
         '''
         # print('')
         # print(f'Timer callback at {time.time()}')
-        for _, ic in self.cc.incoming_clients.items():
+        # The clients are added by the connecting threads,
+        # so the page is built on the snapshot of the clients, it is copied at once.
+        for _, ic in list(self.cc.incoming_clients.items()):
             ic: IncomingClient = ic
 
             # On the ic is disconnected.
@@ -485,18 +575,23 @@ class NiceGuiManager(object):
             # If already has the page.
             # TODO: Update the page.
             if dct := self.pages_container.get(ic.address):
+                # Only the changed elements are updated, the unchanged ones are not sent to the browser.
                 dct['path_label'].text = f'Path: {ic.path}?{ic.uid} {time.ctime()}'
-                dct['status_label'].text = f'Status: {ic.status}'
+                if (status := f'Status: {ic.status}') != dct['status_label'].text:
+                    dct['status_label'].text = status
                 offset = ic.netRemoteTime - ic.netLocalTime
-                dct['quality_label'].text = f"Delay: {ic.netDelay:.4f} | Offset: {offset:.4f}"
+                if (quality := f"Delay: {ic.netDelay:.4f} | Offset: {offset:.4f}") != dct['quality_label'].text:
+                    dct['quality_label'].text = quality
 
                 # Alive spinner.
                 if ic.status is ClientStatus.Disconnected:
                     dct['spinner'].set_visibility(False)
 
                 # Update bags.
+                # The bag is replaced as a whole when it is received, so the unchanged bag is the same object.
                 for k, v in ic.bags.items():
-                    dct['bags'][k].value = v
+                    if dct['bags'][k].value is not v:
+                        dct['bags'][k].value = v
 
                 continue
 
@@ -51,7 +51,8 @@ def _on_key_pressed(event):
     try:
         key = event.key()
         enum = Qt.Key(key)
-        logger.debug(f'Key pressed: {key}, {enum.name}')
+        logger.opt(lazy=True).debug(
+            'Key pressed: {}, {}', lambda: key, lambda: enum.name)
 
         # If esc is pressed, quit the app
         if enum.name == 'Key_Escape':
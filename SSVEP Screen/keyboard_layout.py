@@ -46,7 +46,8 @@ class CueSystem:
         '''
 
         self.cue_sequence.insert(idx, s)
-        logger.debug(f'Pushed cue sequence in {idx}: {self.cue_sequence}')
+        logger.opt(lazy=True).debug(
+            'Pushed cue sequence in {}: {}', lambda: idx, lambda: self.cue_sequence)
         return self.cue_sequence
 
     def extend_cue_sequence(self, lst: Iterable):
@@ -58,7 +59,8 @@ class CueSystem:
         :return: the updated cue sequence.
         '''
         self.cue_sequence.extend(lst)
-        logger.debug(f'Extended cue sequence {self.cue_sequence}')
+        logger.opt(lazy=True).debug(
+            'Extended cue sequence {}', lambda: self.cue_sequence)
         return self.cue_sequence
 
     def clear_cue_sequence(self):
@@ -142,7 +144,8 @@ class InputSystem:
             [self.append_input_buffer(e) for e in inp]
         else:
             self.input_buffer.append(str(inp))
-        logger.debug(f'Appended input_buffer {inp}')
+        logger.opt(lazy=True).debug(
+            'Appended input_buffer {}', lambda: inp)
         return self.input_buffer
 
 
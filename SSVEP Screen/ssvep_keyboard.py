@@ -112,8 +112,8 @@ class MyClient(BaseClientSocket):
             lt.update({'_finished_at': time.time()})
             c2 = json.loads(letter['content'])
             self.queue.put_nowait(c2['decodedOmega'])
-            self.mm.bag_finished.insert_letter(letter)
-            self.mm.bag_finished.insert_letter(lt)
+            self.mm.bag_finished.insert_letter(letter, copy=False)
+            self.mm.bag_finished.insert_letter(lt, copy=False)
 
 
 # Socket client
@@ -398,7 +398,7 @@ class SSVEPScreenPainter(AdditionalFunctions, SSVEPFrequency):
         except Exception as err:
             if lt := client.mm.bag_pending.fetch_letter(letter['uid']):
                 lt.update({'_fail_reason': f'{type(err)}({err})'})
-                client.mm.bag_failed.insert_letter(lt)
+                client.mm.bag_failed.insert_letter(lt, copy=False)
             return
 
         # Got results, write it into every patch.
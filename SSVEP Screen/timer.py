@@ -53,7 +53,7 @@ class RunningTimer(object):
         if passed > self.auto_report_passed:
             self.auto_report_passed += self.auto_report_step
             logger.debug(
-                f'{self.name}: Frame rate: {frame_rate:0.2f}, Passed: {passed:0.2f} seconds')
+                '{}: Frame rate: {:0.2f}, Passed: {:0.2f} seconds', self.name, frame_rate, passed)
 
         return self.frames, frame_rate
 